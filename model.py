@@ -1,5 +1,9 @@
+import bisect
+import copy
 from collections import deque
+import heapq
 import numpy as np
+from scipy import sparse
 
 from matplotlib.text import OffsetFrom
 
@@ -8,6 +12,8 @@ from social import network
 """
 This is the main modeling module, providing classes for:
     - the general classroom model
+    - an equivalent classroom model with array-based state (faster)
+    - the simultaneous simulation of several replicates of a model
     - students
     - seats
     - classroom design
@@ -19,9 +25,265 @@ General usage:
       seed=0):
     - run the model for one time step: m.step()
     - get the current seating distribution: output = m.get_binary_model_state()
+    - get the state after step k (image and info): m.get_model_state_at(k)
+
+    ArrayClassroomModel takes the same arguments and can be used in place of
+    ClassroomModel wherever only step() and the model states are needed.
 """
 
 
+def correlate_interaction(grid, interaction_matrix):
+    """Correlate a (width x num_rows) grid with an interaction matrix, i.e. sum
+    up the weighted grid values around each cell. Cells outside of the grid
+    count as zeros.
+
+    The terms are added in the same order as in Seat.get_social_utility, so
+    that the results are identical.
+
+    Args:
+        grid: matrix of values per seat position. A stack of grids (with
+            the seat positions along the last two axes) is correlated at once.
+        interaction_matrix: weights of the neighboring positions
+
+    Returns:
+        correlation: matrix with the same shape as grid
+
+    """
+    size_x, size_y = interaction_matrix.shape
+    to_center_x, to_center_y = int(size_x/2), int(size_y/2)
+    width, num_rows = grid.shape[-2:]
+
+    padded = np.pad(grid, ((0, 0),) * (grid.ndim - 2)
+                    + ((to_center_x, to_center_x),
+                       (to_center_y, to_center_y)), mode='constant')
+    correlation = np.zeros(grid.shape)
+    for x in range(size_x):
+        for y in range(size_y):
+            correlation += (interaction_matrix[x, y]
+                            * padded[..., x:x+width, y:y+num_rows])
+
+    return correlation
+
+
+class SeatQueue():
+
+    """Priority queue of the empty seats, used for the deterministic seat
+    choice.
+
+    Most of the total utility of a seat does not depend on the student making
+    the decision: an empty seat without seated students in its neighborhood
+    ("quiet" seat) has zero friendship and sociability terms, so its utility
+    only changes when the accessibility of its row changes. Quiet seats are
+    grouped into buckets of equal utility, which are kept in a lazily updated
+    max-heap. Only the remaining empty seats next to seated students are
+    evaluated for each student.
+
+    The queue is used by ClassroomModel. ArrayClassroomModel evaluates all
+    empty seats at once, which is faster there than keeping the queue.
+
+    Args:
+        model: the classroom model
+
+    """
+    def __init__(self, model):
+        self.model = model
+        self.shape = model.shape
+        size_x, size_y = model.friendship_interaction_matrix.shape
+        self.to_center = (int(size_x/2), int(size_y/2))
+
+        # social utility of quiet seats (scaled as in get_social_utility)
+        s_min, s_max = model.sociability_range
+        if s_max > s_min:
+            self.u_sociability = np.maximum(0, 0.0 - s_min) / (s_max - s_min)
+        else:
+            self.u_sociability = s_min
+
+        # number of seated students in the neighborhood of each position
+        self.occupied = model.occupancy >= 0
+        self.num_neighbors = correlate_interaction(
+            self.occupied, np.ones((size_x, size_y)))
+
+        self.buckets = {}   # utility -> set of flat indices of quiet seats
+        self.heap = []      # negative utilities of the buckets
+        self.utilities = {} # flat index -> utility of a quiet seat
+        self.noisy = set()  # flat indices of the other empty seats
+
+        xs, ys = np.nonzero(model.seat_mask & ~self.occupied)
+        self.evaluate(xs, ys)
+
+    def evaluate(self, xs, ys):
+        """Sort the given seats into the quiet buckets or the noisy seats."""
+        if len(xs) == 0:
+            return
+        model = self.model
+        coef_p, coef_f, coef_s, coef_a = model.coefs
+        utilities = (coef_p * model.classroom.pos_utilities[xs, ys]
+                     + coef_f * 0.0
+                     + coef_s * self.u_sociability
+                     + coef_a * model.get_accessibility(xs, ys))
+
+        for index, x, y, utility in zip(
+                np.ravel_multi_index((xs, ys), self.shape).tolist(),
+                xs, ys, utilities.tolist()):
+            self.remove(index)
+            if self.occupied[x, y]:
+                continue
+            if self.num_neighbors[x, y] > 0:
+                self.noisy.add(index)
+            else:
+                self.utilities[index] = utility
+                if utility not in self.buckets:
+                    self.buckets[utility] = set()
+                    heapq.heappush(self.heap, -utility)
+                self.buckets[utility].add(index)
+
+    def remove(self, index):
+        """Remove the seat with the given flat index from the queue."""
+        self.noisy.discard(index)
+        utility = self.utilities.pop(index, None)
+        if utility is not None:
+            self.buckets[utility].discard(index)
+
+    def update(self, x, y):
+        """Update the queue after seat (x, y) has been taken or freed and the
+        accessibility of its row has been updated."""
+        model = self.model
+        width, num_rows = self.shape
+        to_center_x, to_center_y = self.to_center
+        occupied = model.occupancy[x, y] >= 0
+
+        x_min, x_max = max(x - to_center_x, 0), min(x + to_center_x + 1, width)
+        y_min, y_max = (max(y - to_center_y, 0),
+                        min(y + to_center_y + 1, num_rows))
+        if occupied != self.occupied[x, y]:
+            self.occupied[x, y] = occupied
+            self.num_neighbors[x_min:x_max, y_min:y_max] += (
+                1 if occupied else -1)
+
+        # the neighborhood and the whole row of the seat change
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[x_min:x_max, y_min:y_max] = True
+        mask[:, y] = True
+        xs, ys = np.nonzero(mask & model.seat_mask)
+        self.evaluate(xs, ys)
+
+    def get_best_seats(self, student_id):
+        """Get the flat indices of all empty seats with the highest total
+        utility for the given student, ordered as the empty seats of the
+        model.
+
+        Args:
+            student_id: ID of the student making the seating decision
+
+        Returns:
+            best_seats: array of flat seat indices
+
+        """
+        # drop empty buckets from the top of the heap
+        while self.heap and not self.buckets[-self.heap[0]]:
+            del self.buckets[-heapq.heappop(self.heap)]
+
+        best_utility = -self.heap[0] if self.heap else -np.inf
+        best_seats = []
+
+        if self.noisy:
+            noisy = np.array(sorted(self.noisy))
+            xs, ys = np.unravel_index(noisy, self.shape)
+            utilities = self.model.get_total_utility(student_id, xs, ys)
+            best_noisy = np.max(utilities)
+            if best_noisy >= best_utility:
+                best_seats = noisy[utilities == best_noisy].tolist()
+                if best_noisy > best_utility:
+                    return np.array(best_seats)
+
+        if self.heap:
+            best_seats = sorted(self.buckets[best_utility] | set(best_seats))
+        return np.array(best_seats)
+
+
+class TopFractionChoice():
+
+    """Probabilistic seat choice among the best seats.
+
+    The best 'seat_fraction' (e.g. 50%) of all available seats are
+    determined and one of them is chosen with probability proportional to its
+    utility. If none of them has a positive utility, a seat is chosen
+    randomly among all available seats.
+
+    Args:
+        seat_fraction: fraction of available seats to be considered
+
+    """
+    def __init__(self, seat_fraction=0.5):
+        self.seat_fraction = seat_fraction
+
+    def choose(self, rand, seat_options, seat_utilities):
+        """Choose one of the given seat options.
+
+        Args:
+            rand: random number generator of the model
+            seat_options: list or array of available seats
+            seat_utilities: total utility of each seat option
+
+        Returns:
+            seat_choice: the chosen element of seat_options
+
+        """
+        seat_utilities = np.asarray(seat_utilities, dtype=float)
+        num_best = int(self.seat_fraction * len(seat_utilities))
+
+        # Seats without positive utility are never chosen among the best
+        # seats
+        best = np.flatnonzero(seat_utilities > 0)
+        if num_best == 0 or len(best) == 0:
+            return rand.choice(seat_options)
+
+        if len(best) > num_best:
+            # Keep the num_best highest utilities, preferring seats that come
+            # first in case of ties
+            threshold = np.partition(
+                seat_utilities[best], len(best) - num_best)[
+                    len(best) - num_best]
+            above = best[seat_utilities[best] > threshold]
+            ties = best[seat_utilities[best] == threshold]
+            best = np.sort(np.concatenate(
+                [above, ties[:num_best - len(above)]]))
+
+        # Order by decreasing utility and convert utilities into probabilities
+        # (the utilities are summed up one after another)
+        best = best[np.argsort(-seat_utilities[best], kind='stable')]
+        utility_subset = seat_utilities[best]
+        probabilities = utility_subset / np.cumsum(utility_subset)[-1]
+
+        return rand.choice(np.asarray(seat_options)[best], p=probabilities)
+
+
+class SoftmaxChoice():
+
+    """Probabilistic seat choice following a logit model.
+
+    Each available seat is chosen with probability proportional to
+    exp(utility / temperature). Low temperatures approach the deterministic
+    choice, high temperatures a random choice.
+
+    Args:
+        temperature: positive scale of the utility differences
+
+    """
+    def __init__(self, temperature=0.1):
+        if temperature <= 0:
+            raise ValueError("'temperature' must be positive")
+        self.temperature = temperature
+
+    def choose(self, rand, seat_options, seat_utilities):
+        """Choose one of the given seat options (see TopFractionChoice.choose)."""
+        seat_utilities = np.asarray(seat_utilities, dtype=float)
+        weights = np.exp(
+            (seat_utilities - np.max(seat_utilities)) / self.temperature)
+
+        return rand.choice(np.asarray(seat_options), p=weights/np.sum(weights))
+
+
 class Student():
 
     """Create a student with individual characteristics
@@ -40,13 +302,9 @@ class Student():
 
         # initial state of the student
         self.seated = False
+        self.seat = None
         self.initial_happiness = 0
 
-        # Currently not used, but here incase of future study
-        self.will_to_change_seat = False
-        self.moving_threshold = 1
-        self.moving_prob = 0.05
-
     def choose_seat(self, seat_pos=None, old_seat=None):
         """The seat selection procedure.
 
@@ -56,13 +314,23 @@ class Student():
                 parameter is specified utilities are ignored.
 
             old_seat: current seat of the student making the seating decision.
-            If this parameter is specified the student is enabled to move to a
-            seat with higher utility than his current one.
+            If this parameter is specified the student moves to a seat with
+            higher utility than his current one, if there is a much better one
+            (see ClassroomModel.choose_new_seat).
 
         """
         seat_choice = None
 
-        if seat_pos is None:
+        if seat_pos is None and old_seat is not None:
+            # Only used in the relocation phase: if the difference in utility
+            # between the current seat (including the cost to get away from
+            # it) and the best available seat exceeds the threshold, move to
+            # one of the optimal ones
+            seat_index = self.model.choose_new_seat(self.unique_id)
+            if seat_index is not None:
+                seat_choice = self.model.seats.flat[seat_index]
+
+        elif seat_pos is None:
             # Determine all possible seats to choose from
             seat_options = self.model.empty_seats
 
@@ -73,63 +341,28 @@ class Student():
                 if self.model.random_seat_choice:
                     # Pick one randomly
                     seat_choice = self.model.rand.choice(seat_options)
+                elif self.model.deterministic_choice:
+                    # Always choose among the seats with highest utility,
+                    # which are kept in the seat queue
+                    best_seats = (self.model.get_seat_queue()
+                                  .get_best_seats(self.unique_id))
+                    seat_choice = self.model.seats.flat[
+                        self.model.rand.choice(best_seats)]
+
                 else:
-                    if old_seat is None:
-                        seat_utilities = [seat.get_total_utility(self)
-                                          for seat in seat_options]
-
-                        if self.model.deterministic_choice:
-                            # Always choose among the seats with highest
-                            # utility
-                            seat_choice = self.model.rand.choice(
-                                np.array(seat_options)[np.where(
-                                    seat_utilities == np.max(seat_utilities))])
-
-                        else:
-
-                            # Determine the best 'seat_fraction' (e.g. 50%) of
-                            # all available seats
-                            seat_subset, utility_subset = [], []
-                            for i in range(int(self.model.seat_fraction
-                                               * len(seat_options))):
-                                index = np.argmax(seat_utilities)
-                                seat_subset.append(seat_options[index])
-                                utility_subset.append(seat_utilities[index])
-                                seat_utilities[index] = 0
-                            sum_utilities = sum(utility_subset)
-
-                            if sum_utilities > 0:
-                                # Convert utilities into probabilities and
-                                # choose seat based on the resulting
-                                # probability distribution
-                                utility_subset = [
-                                    s/sum_utilities for s in utility_subset]
-                                seat_choice = self.model.rand.choice(
-                                    seat_subset, p=utility_subset)
-                            else:
-                                # If all utilities are zero, choose the seat
-                                # randomly
-                                seat_choice = self.model.rand.choice(
-                                    seat_options)
-                    # Only used if 'will_to_change_seat' is enabled
-                    else:
-                        # Pick seat with highest utiltiy (if multiple seats are
-                        # optimal, choose one of them randomly) include cost to
-                        # get away from the old seat
-                        seat_utilities = [seat.get_total_utility(self)
-                                          - old_seat.get_stand_up_cost()
-                                          for seat in seat_options]
-
-                        if (np.max(seat_utilities)
-                                - old_seat.get_total_utility(self)
-                                > self.moving_threshold):
-                            # If the difference in utility between the current
-                            # seat and another available seat exceeds the
-                            # threshold, move to one of the optimal ones
-                            seat_choice = self.model.rand.choice(
-                                np.array(seat_options)[
-                                    np.where(seat_utilities
-                                             == np.max(seat_utilities))])
+                    # Determine the social utilities of all seats at once
+                    u_friendship, u_sociability = (
+                        self.model.get_social_utilities(self))
+                    seat_utilities = [
+                        seat.get_total_utility(
+                            self, (u_friendship[seat.pos],
+                                   u_sociability[seat.pos]))
+                        for seat in seat_options]
+
+                    # Choose probabilistically based on the utilities (e.g.
+                    # among the best 'seat_fraction' of all available seats)
+                    seat_choice = self.model.choice_policy.choose(
+                        self.model.rand, seat_options, seat_utilities)
         else:
             # Get the seat object at the predetermined position
             seat = self.model.seats[seat_pos]
@@ -139,43 +372,49 @@ class Student():
         if seat_choice is not None:
             # seat has been selected
             if old_seat is not None:
-                # make seat available again
+                # make seat available again, keeping the empty seats ordered
+                # by column and row
                 old_seat.student = None
-                self.empty_seats.append(old_seat)
+                self.model.empty_seats.insert(
+                    bisect.bisect([s.pos for s in self.model.empty_seats],
+                                  old_seat.pos),
+                    old_seat)
+                self.model.update_occupancy(old_seat)
+                self.update_row_accessibility(old_seat.pos[1])
+                self.model.seat_changed(old_seat.pos)
 
             # move to the selected seat
             seat_choice.student = self
+            self.model.update_occupancy(seat_choice)
             self.initial_happiness = seat_choice.get_happiness(self)
+            self.model.initial_happiness[self.unique_id] = self.initial_happiness
             self.seated = True
+            self.seat = seat_choice
 
             # update the accessibility of all seats in the row
-            for s in self.model.seats[:, seat_choice.pos[1]]:
-                if type(s) == Seat:
-                    s.update_accessibility()
+            self.update_row_accessibility(seat_choice.pos[1])
+            self.model.seat_changed(seat_choice.pos)
 
             self.model.empty_seats.remove(seat_choice)
 
+    def update_row_accessibility(self, y):
+        """Update the accessibility of all seats in row y."""
+        for s in self.model.seats[:, y]:
+            if type(s) == Seat:
+                s.update_accessibility()
+
     def step(self):
-        """At each tick the student either selects a seat or stays at its current seat.
+        """At each tick the student either selects a seat or reconsiders its
+        current seat (see ClassroomModel.relocate).
 
         """
-        # Only choose another seat if not seated yet or if the student has the
-        # characteristic to change its seat again
         if not self.seated:
             # choose and move to seat
             self.choose_seat()
-
-        if self.will_to_change_seat:
-            # With the given probability the student searches for a better seat
-            r = self.model.rand.uniform()
-            if r < self.moving_prob:
-                # Compare current seat utility with all other available seats.
-                # If there is a much better one, move
-                try:
-                    seat = self.model.seats[self.pos]
-                    self.choose_seat(seat)
-                except:
-                    return
+        else:
+            # Compare current seat utility with all other available seats.
+            # If there is a much better one, move
+            self.choose_seat(old_seat=self.seat)
 
 
 class Seat():
@@ -194,22 +433,19 @@ class Seat():
         self.accessibility = 1
         self.pos = pos
 
-        x, y = pos
+        # cached list of students within the interaction range (see
+        # get_occupied_neighbors)
+        self.occupied_neighbors = None
 
-        # Find the distances to the left and right aisles, for accessibility
-        if x < model.classroom.aisles_x[0]:
-            # Then no aisle to the left
-            self.row_left = None
-        else:
-            left_aisle = max([a for a in model.classroom.aisles_x if a < x])
-            self.row_left = [(i, y) for i in range(left_aisle+1, x)]
+        x, y = pos
 
-        if x > model.classroom.aisles_x[-1]:
-            # Then no aisle to the right
-            self.row_right = None
-        else:
-            right_aisle = min([a for a in model.classroom.aisles_x if a > x])
-            self.row_right = [(i, y) for i in range(x+1, right_aisle)]
+        # The nearest left and right aisles, for accessibility (None if there
+        # is no aisle on that side)
+        layout = model.layout
+        self.left_aisle = (
+            layout.left_aisle_list[x] if layout.has_left_aisle[x] else None)
+        self.right_aisle = (
+            layout.right_aisle_list[x] if layout.has_right_aisle[x] else None)
 
     def get_position_utility(self):
         """Get the position utility of the seat, based on its location in the
@@ -231,72 +467,61 @@ class Seat():
         substracted from one in order to obtain values between 0 (number of
         students to be passed is maximal) and 1 (no students to be passed).
 
+        The student counts are looked up in constant time from the occupancy
+        prefix counts of the row (see ClassroomModel.update_row_counts).
+
         Returns:
             u_accessibility: utiltiy in range [0,1]
 
         """
         x, y = self.pos
+        row_counts = self.model.row_counts[y]
 
-        count_left, count_right = 0, 0
-
-        if self.row_left is not None:
-            for cell in self.row_left:
-                if self.model.seats[cell].student:
-                    count_left += 1
+        if self.left_aisle is not None:
+            count_left = row_counts[x] - row_counts[self.left_aisle + 1]
         else:
             count_left = np.infty
 
-        if self.row_right is not None:
-            for cell in self.row_right:
-                if self.model.seats[cell].student:
-                    count_right += 1
+        if self.right_aisle is not None:
+            count_right = row_counts[self.right_aisle] - row_counts[x + 1]
         else:
             count_right = np.infty
 
         self.accessibility = 1 - min(count_right, count_left)/float(
             self.model.classroom.max_pass)
 
-    def get_neighborhood(self, size_x, size_y):
-        """Get the local neighborhood around the Seat
+    def get_occupied_neighbors(self):
+        """Get the students seated within the interaction range of the Seat.
 
-        Args:
-            size_x: width of the neighborhood
-            size_y: height of the neighborhood
+        The list is cached and only rebuilt after the model has invalidated it,
+        i.e. after a seat within the interaction range was taken or freed.
 
-        Returns: neighborhood: matrix containing IDs of neighboring students
-            (-1 means empty or no seat at all)
+        Returns:
+            occupied_neighbors: list of tuples (x, y, student_id), where (x, y)
+                is the position in the interaction matrices
 
         """
-
-        x, y = self.pos
-
-        # Assure that size_x and size_y are odd, so that the neighborhood has
-        # one central seat
-        if size_x % 2 == 0:
-            size_x -= 1
-        if size_y % 2 == 0:
-            size_y -= 1
-
-        neighborhood = -np.ones((size_x, size_y))
-        to_center_x = int(size_x/2)
-        to_center_y = int(size_y/2)
-
-        for i in range(size_x):
-            for j in range(size_y):
-
-                coords = (x + i - to_center_x, y + j - to_center_y)
-
-                if (coords[0] < 0) or (coords[0] > self.model.classroom.width) or (coords[1] < 0) or (coords[1] > self.model.classroom.num_rows):
-                    continue
-
-                else:
-                    try:
-                        seat = self.model.seats[coords]
-                        neighborhood[i, j] = seat.student.unique_id
-                    except:
-                        continue
-
-        return neighborhood
+        if self.occupied_neighbors is None:
+            interaction_x, interaction_y = (
+                self.model.friendship_interaction_matrix.shape)
+            offsets_x, offsets_y, flat_offsets = (
+                self.model.layout.get_neighbor_offsets(
+                    interaction_x, interaction_y))
+
+            # look up the neighbors within the classroom in the occupancy grid
+            x, y = self.pos
+            width, num_rows = self.model.shape
+            inside = ((x + offsets_x >= 0) & (x + offsets_x < width)
+                      & (y + offsets_y >= 0) & (y + offsets_y < num_rows))
+            neighbors = -np.ones(len(flat_offsets), dtype=int)
+            neighbors[inside] = self.model.occupancy.ravel()[
+                x * num_rows + y + flat_offsets[inside]]
+
+            self.occupied_neighbors = [
+                (i // interaction_y, i % interaction_y, n)
+                for i, n in enumerate(neighbors.tolist()) if n >= 0]
+
+        return self.occupied_neighbors
 
     def get_social_utility(self, student):
         """Get the social utility of the Seat (including both friendship and
@@ -323,28 +548,22 @@ class Seat():
 
         """
 
-        interaction_x, interaction_y = (
-            self.model.friendship_interaction_matrix.shape)
-
-        neighborhood = self.get_neighborhood(interaction_x, interaction_y)
         u_friendship = 0
         u_sociability = 0
 
-        for x in range(interaction_x):
-            for y in range(interaction_y):
+        # only the neighboring seats that are occupied by a student matter
+        neighbors = self.get_occupied_neighbors()
+        friendships = self.model.get_friendships(
+            int(student.unique_id), [n for _, _, n in neighbors])
 
-                # if there is a student check friendship
-                if neighborhood[x,y] >= 0:
-                    friendship = self.model.social_network[
-                        int(student.unique_id), int(neighborhood[x,y])]
+        for (x, y, neighbor_id), friendship in zip(neighbors, friendships):
+            u_friendship += self.model.friendship_interaction_matrix[x, y] * friendship
 
-                    u_friendship += self.model.friendship_interaction_matrix[x, y] * friendship
-
-                    # If neighbouring seat is occupied by a student that is not
-                    # a friend, determine the sociability component based on
-                    # the student's sociability attribute
-                    if friendship == 0:
-                        u_sociability += self.model.sociability_interaction_matrix[x,y] * student.sociability
+            # If neighbouring seat is occupied by a student that is not a
+            # friend, determine the sociability component based on the
+            # student's sociability attribute
+            if friendship == 0:
+                u_sociability += self.model.sociability_interaction_matrix[x,y] * student.sociability
 
         # scale the final sociability term to range [0,1]
         s_min, s_max = self.model.sociability_range
@@ -355,14 +574,22 @@ class Seat():
 
         return u_friendship, u_sociability
 
-    def get_total_utility(self, student):
+    def get_total_utility(self, student, social_utility=None):
         """ Get the overall utility of the Seat as a linear combination of position,
         friendship, sociability and accessibility components
 
+        Args:
+            student: the student making the seating choice
+            social_utility: precomputed tuple (u_friendship, u_sociability)
+                for this seat (see ClassroomModel.get_social_utilities). If
+                not given, it is determined by get_social_utility.
+
         Returns:
             total_utility: high values represent high attractivity of the seat
         """
-        friendship_component, sociability_component = self.get_social_utility(student)
+        if social_utility is None:
+            social_utility = self.get_social_utility(student)
+        friendship_component, sociability_component = social_utility
         coef_p, coef_f, coef_s, coef_a = self.model.coefs
         total_utility = (
             coef_p * self.get_position_utility()
@@ -394,7 +621,704 @@ class Seat():
         return total_utility
 
 
-class ClassroomModel():
+class ModelSnapshot():
+
+    """The full state of a classroom model at one step (see
+    _ClassroomModelBase.snapshot). All arrays are read-only copies, so a
+    snapshot can be shared by any number of forks.
+
+    Attributes:
+        num_steps, num_students: progress of the simulation
+        occupancy: (width x num_rows) matrix of student IDs
+        accessibility: (width x num_rows) matrix of seat accessibilities
+        sociabilities, initial_happiness, student_seats, needs_evaluation:
+            student attributes, indexed by the student IDs
+        sociability_sequence: sociabilities of the students yet to arrive
+        sociability_range: (min, max) used for scaling the sociability term
+        rand_state: state of the random number generator
+        social_network, friendship_keys: the (shared) social network
+        coefs: coefficients of the utility function
+        seating_events, model_states: logged events and recorded states
+
+    """
+    def __init__(self, model):
+        self.num_steps = model.num_steps
+        self.num_students = model.num_students
+
+        self.occupancy = model.occupancy.copy()
+        self.accessibility = np.ones(model.shape)
+        xs, ys = model.layout.seat_xs, model.layout.seat_ys
+        self.accessibility[xs, ys] = model.get_accessibility(xs, ys)
+        self.sociabilities = model.sociabilities.copy()
+        self.initial_happiness = model.initial_happiness.copy()
+        self.student_seats = model.student_seats.copy()
+        self.needs_evaluation = model.needs_evaluation.copy()
+        for array in (self.occupancy, self.accessibility, self.sociabilities,
+                      self.initial_happiness, self.student_seats,
+                      self.needs_evaluation):
+            array.flags.writeable = False
+
+        self.sociability_sequence = tuple(model.sociability_sequence)
+        self.sociability_range = model.sociability_range
+        self.rand_state = model.rand.get_state()
+        self.social_network = model.social_network
+        self.friendship_keys = model._friendship_keys
+        self.coefs = list(model.coefs)
+        self.seating_events = tuple(model.seating_events)
+        self.model_states = tuple(model.model_states)
+
+
+class _ClassroomModelBase():
+
+    """Common parts of the classroom models: random number generation, utility
+    coefficients, social network, sociabilities of the students, the
+    occupancy grid and the recording of model states.
+
+    Args: see ClassroomModel
+
+    """
+    def __init__(self, classroom_design, coefs=[0.25, 0.25, 0.25, 0.25],
+                 sociability_sequence=None, social_network=None,
+                 degree_sequence=None, seed=0,
+                 seat_fraction=0.5, deterministic_choice=True, scale=True,
+                 record_states="full", choice_policy=None, moving_prob=0,
+                 moving_threshold=0.1):
+        self.configure(classroom_design, coefs, sociability_sequence,
+                       social_network, degree_sequence, seat_fraction,
+                       deterministic_choice, scale, record_states,
+                       choice_policy, moving_prob, moving_threshold)
+        self.reset(seed)
+
+    @classmethod
+    def template(cls, classroom_design, coefs=[0.25, 0.25, 0.25, 0.25],
+                 sociability_sequence=None, social_network=None,
+                 degree_sequence=None, seat_fraction=0.5,
+                 deterministic_choice=True, scale=True, record_states="full",
+                 choice_policy=None, moving_prob=0, moving_threshold=0.1):
+        """Create a template of a model with the given configuration (see
+        ClassroomModel), from which models are created with clone(seed). The
+        parts that depend on the seed (e.g. the social network) are not set
+        up, so the template itself cannot be simulated.
+
+        """
+        model = cls.__new__(cls)
+        model.configure(classroom_design, coefs, sociability_sequence,
+                        social_network, degree_sequence, seat_fraction,
+                        deterministic_choice, scale, record_states,
+                        choice_policy, moving_prob, moving_threshold)
+        return model
+
+    def configure(self, classroom_design, coefs, sociability_sequence,
+                  social_network, degree_sequence, seat_fraction,
+                  deterministic_choice, scale, record_states, choice_policy,
+                  moving_prob, moving_threshold):
+        """Set up the parts of the model that do not depend on the seed (see
+        reset). The arguments are those of ClassroomModel."""
+        self.classroom = classroom_design
+        self.seat_fraction = seat_fraction
+        self.deterministic_choice = deterministic_choice
+        if choice_policy is None:
+            choice_policy = TopFractionChoice(seat_fraction)
+        self.choice_policy = choice_policy
+        self.moving_prob = moving_prob
+        self.moving_threshold = moving_threshold
+
+        self.scale = scale
+        self.set_coefs(coefs)
+
+        # The inputs from which the random parts of the model (social network,
+        # order of the students) are generated for each seed (see reset). They
+        # are copied before shuffling.
+        self.degree_sequence = degree_sequence
+        self.given_sociability_sequence = sociability_sequence
+        self.given_social_network = None
+        if social_network is not None:
+            self.max_num_agents = social_network.shape[0]
+            self.given_social_network = self.set_social_network(social_network)
+        elif degree_sequence is None:
+            self.max_num_agents = self.classroom.seat_count
+        else:
+            self.max_num_agents = len(degree_sequence)
+
+        if (sociability_sequence is not None
+                and len(sociability_sequence) != self.max_num_agents):
+            raise ValueError("'sociability_sequence' and 'degree_sequence' must have same length")
+
+        # Matrices that determine the importance of neighboring seats for the
+        # social utility. They need to have the same shape. Values should sum
+        # up to one so that the resulting friendship and sociability terms are
+        # within range [0,1].
+        self.friendship_interaction_matrix = np.array([[0.5, 0, 0.5]]).T
+        self.sociability_interaction_matrix = np.array([[0.5, 0, 0.5]]).T
+
+        width, num_rows = self.classroom.width, self.classroom.num_rows
+        self.shape = (width, num_rows)
+
+        # Static layout arrays, shared by all models of the same design.
+        # Referenced as x, y (i.e. column then row!). Aisles are no seats.
+        self.layout = self.classroom.get_layout_index()
+        self.seat_mask = self.layout.seat_mask
+
+        # Nearest aisles to the left and right of each column (see
+        # LayoutIndex)
+        self.has_left_aisle = self.layout.has_left_aisle
+        self.has_right_aisle = self.layout.has_right_aisle
+        self.left_aisle = self.layout.left_aisle
+        self.right_aisle = self.layout.right_aisle
+
+        # Which model states are stored in model_states: "full" (every step),
+        # "final" (only after the last student is seated), "none" or an
+        # integer N (every N steps). Independent of this setting, every
+        # seating decision is logged as a tuple (step, student_id, (x, y)),
+        # from which any model state can be reconstructed on demand.
+        if not (record_states in ("full", "final", "none")
+                or (isinstance(record_states, int) and record_states > 0)):
+            raise ValueError("'record_states' must be 'full', 'final', 'none' or a positive integer")
+        self.record_states = record_states
+
+    def reset(self, seed=0):
+        """Bring the model into its initial state, using the given seed. Only
+        the parts of the model that depend on random numbers or change during
+        the simulation are (re)created, everything else is kept.
+
+        Args:
+            seed: seed for the random number generation
+
+        """
+        self.rand = np.random.RandomState(seed)
+        self.model_states = []   # all simulated model states stored here
+        self.im = None   # used to store the current image
+
+        # Setup the social network
+        if self.given_social_network is not None:
+            (self.social_network,
+             self._friendship_keys) = self.given_social_network
+        elif self.degree_sequence is None:
+            # create a random network
+            self.set_social_network(
+                network.erdos_renyi(self.max_num_agents, 0.2)[0])
+        else:
+            degree_sequence = copy.copy(self.degree_sequence)
+            self.rand.shuffle(degree_sequence)
+            self.set_social_network(network.configuration_graph(
+                degree_sequence, self.rand)[0])
+
+        # set up the sociabilities of the students
+        if self.given_sociability_sequence is None:
+            # default sociability values are sampled uniformly from [0,1]
+            self.sociability_sequence = deque(
+                [self.rand.uniform(0, 1) for _ in range(self.max_num_agents)])
+        else:
+            sociability_sequence = copy.copy(self.given_sociability_sequence)
+            self.rand.shuffle(sociability_sequence)
+            self.sociability_sequence = deque(sociability_sequence)
+        self.sociability_range = (min(self.sociability_sequence),
+                                  max(self.sociability_sequence))
+
+        # IDs of the seated students (-1 means empty or no seat at all)
+        self.occupancy = -np.ones(self.shape, dtype=int)
+
+        # student attributes, indexed by the student IDs
+        self.sociabilities = np.zeros(self.max_num_agents)
+        self.initial_happiness = np.zeros(self.max_num_agents)
+
+        # flat index of the seat of each student (-1 if not seated yet) and
+        # whether the student should reconsider its seat (see relocate)
+        self.student_seats = -np.ones(self.max_num_agents, dtype=int)
+        self.needs_evaluation = np.zeros(self.max_num_agents, dtype=bool)
+
+        self.num_steps = 0
+        self.seating_events = []
+
+        # Empty seats ordered by utility for the deterministic seat choice
+        # (see get_seat_queue)
+        self.seat_queue = None
+
+    def clone(self, seed=0):
+        """Create a fresh model with the same configuration, but a different
+        seed. The static parts (classroom design, layout, coefficients, given
+        sequences and networks) are shared with this model instead of being
+        set up again.
+
+        Args:
+            seed: seed for the random number generation of the new model
+
+        Returns:
+            model: the new model in its initial state
+
+        """
+        model = copy.copy(self)
+        model.reset(seed)
+        return model
+
+    def set_coefs(self, coefs):
+        """Set the coefficients [coef_p, coef_f, coef_s, coef_a] of the utility
+        function."""
+        # Assure that the coefficients sum up to one
+        if self.scale:
+            self.coefs = [(c/sum(coefs) if sum(coefs) > 0 else 0)
+                          for c in coefs]
+        else:
+            self.coefs = coefs
+
+        # If all utility components are set to zero, seat choices are
+        # completely random
+        self.random_seat_choice = np.all(coefs == 0)
+
+    def snapshot(self):
+        """Capture the current state of the model, from which the simulation
+        can be continued any number of times (see fork).
+
+        Returns:
+            snapshot: ModelSnapshot instance
+
+        """
+        return ModelSnapshot(self)
+
+    def fork(self, snapshot=None, seed=None, coefs=None,
+             sociability_sequence=None):
+        """Create a new model that continues the simulation from the given
+        snapshot of this model (or from the current state).
+
+        The fork shares the static parts of the model and the snapshot's social
+        network instead of copying them. Only the small state matrices and
+        student vectors are copied, so the fork and this model can be
+        simulated independently.
+
+        Args:
+            snapshot: ModelSnapshot taken from this model. If not given, the
+                current state is used.
+            seed: if given, the fork continues with a new random number
+                generator using this seed. Otherwise it continues the random
+                number sequence of the snapshot.
+            coefs: if given, the fork uses these coefficients for the utility
+                function (scaled as in the constructor)
+            sociability_sequence: if given, the sociabilities of the students
+                who have not arrived yet (in order of arrival). The sociability
+                range is updated accordingly.
+
+        Returns:
+            model: the forked model
+
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        model = copy.copy(self)
+        model.restore(snapshot)
+
+        if seed is not None:
+            model.rand = np.random.RandomState(seed)
+        if coefs is not None:
+            model.set_coefs(coefs)
+        if sociability_sequence is not None:
+            if (len(sociability_sequence)
+                    != model.max_num_agents - model.num_students):
+                raise ValueError("'sociability_sequence' must contain one value per remaining student")
+            model.sociability_sequence = deque(sociability_sequence)
+            sociabilities = np.concatenate(
+                [model.sociabilities[:model.num_students],
+                 sociability_sequence])
+            model.sociability_range = (min(sociabilities), max(sociabilities))
+
+        return model
+
+    def restore(self, snapshot):
+        """Bring the model into the state of the given snapshot (see fork)."""
+        self.occupancy = snapshot.occupancy.copy()
+        self.sociabilities = snapshot.sociabilities.copy()
+        self.initial_happiness = snapshot.initial_happiness.copy()
+        self.student_seats = snapshot.student_seats.copy()
+        self.needs_evaluation = snapshot.needs_evaluation.copy()
+
+        self.sociability_sequence = deque(snapshot.sociability_sequence)
+        self.sociability_range = snapshot.sociability_range
+        self.rand = np.random.RandomState()
+        self.rand.set_state(snapshot.rand_state)
+        self.social_network = snapshot.social_network
+        self._friendship_keys = snapshot.friendship_keys
+        self.set_coefs(snapshot.coefs)
+
+        self.num_steps = snapshot.num_steps
+        self.seating_events = list(snapshot.seating_events)
+        self.model_states = list(snapshot.model_states)
+        self.im = None
+        self.seat_queue = None
+
+    def set_social_network(self, social_network):
+        """Use the given connectivity matrix (dense or scipy.sparse) as social
+        network.
+
+        It is stored in CSR format for fast lookups of friendships, also for
+        large classes. Each stored friendship gets a sorted key (row * N +
+        column), so that arbitrary pairs of students can be looked up by binary
+        search.
+
+        Returns:
+            social_network, friendship_keys: the stored network and keys
+
+        """
+        self.social_network = sparse.csr_matrix(social_network, copy=True)
+        self.social_network.sum_duplicates()
+        self._friendship_keys = (
+            np.repeat(np.arange(self.max_num_agents, dtype=np.int64),
+                      np.diff(self.social_network.indptr))
+            * self.max_num_agents + self.social_network.indices)
+        return self.social_network, self._friendship_keys
+
+    def get_friendship_row(self, student_id):
+        """Get the friendship values of the given student with all students.
+
+        Returns:
+            friendships: vector of length max_num_agents
+
+        """
+        start, end = self.social_network.indptr[student_id:student_id+2]
+        friendships = np.zeros(self.max_num_agents)
+        friendships[self.social_network.indices[start:end]] = (
+            self.social_network.data[start:end])
+        return friendships
+
+    def get_friendships(self, student_ids, other_ids):
+        """Get the friendship values between pairs of students.
+
+        Args:
+            student_ids: IDs of the students (scalar or one per pair)
+            other_ids: IDs of the other students
+
+        Returns:
+            friendships: vector with one value per pair
+
+        """
+        keys = (np.asarray(student_ids, dtype=np.int64) * self.max_num_agents
+                + np.asarray(other_ids, dtype=np.int64)).ravel()
+        friendships = np.zeros(len(keys))
+        if len(self._friendship_keys) == 0:
+            return friendships
+
+        index = np.searchsorted(self._friendship_keys, keys)
+        index[index == len(self._friendship_keys)] = 0
+
+        found = self._friendship_keys[index] == keys
+        friendships[found] = self.social_network.data[index[found]]
+        return friendships
+
+    def record_model_state(self):
+        """Store the current model state in model_states if required by the
+        recording mode."""
+        if self.record_states == "full":
+            self.model_states.append(self.get_model_state())
+        elif self.record_states == "final":
+            if self.num_steps >= self.max_num_agents:
+                self.model_states = [self.get_model_state()]
+        elif self.record_states != "none":
+            if self.num_steps % self.record_states == 0:
+                self.model_states.append(self.get_model_state())
+
+    def log_seating(self, student_id, pos):
+        """Log that the given student took the seat at the given position in
+        the current step."""
+        self.seating_events.append(
+            (self.num_steps, int(student_id), (int(pos[0]), int(pos[1]))))
+        self.student_seats[student_id] = np.ravel_multi_index(pos, self.shape)
+
+    def get_occupancy_at(self, step):
+        """Reconstruct the occupancy grid after the given step from the seating
+        events.
+
+        Args:
+            step: number of steps (negative values count back from the current
+                step, i.e. -1 is the current state)
+
+        Returns:
+            occupancy: (width x num_rows) matrix of student IDs (-1 means empty
+                or no seat at all)
+
+        """
+        if step < 0:
+            step += self.num_steps + 1
+
+        occupancy = -np.ones(self.shape, dtype=int)
+        student_seats = {}
+        for event_step, student_id, pos in self.seating_events:
+            if event_step > step:
+                break
+            if student_id in student_seats:
+                # the student moved, so the old seat is available again
+                occupancy[student_seats[student_id]] = -1
+            occupancy[pos] = student_id
+            student_seats[student_id] = pos
+
+        return occupancy
+
+    def get_model_state_at(self, step):
+        """Reconstruct the model state (see get_model_state) after the given
+        step from the seating events.
+
+        Args:
+            step: number of steps (negative values count back from the current
+                step, i.e. -1 is the current state)
+
+        """
+        occupancy = self.get_occupancy_at(step)
+        return self.render_model_state(
+            occupancy, self.get_accessibility_grid(occupancy))
+
+    def get_accessibility_grid(self, occupancy):
+        """Get the accessibility of all seats for the given occupancy grid (see
+        Seat.update_accessibility).
+
+        Args:
+            occupancy: matrix of student IDs with one column per classroom
+                column (-1 means empty)
+
+        Returns:
+            accessibility: matrix with the same shape as occupancy
+
+        """
+        occupied = (occupancy >= 0).astype(int)
+        counts = np.zeros((occupied.shape[0] + 1, occupied.shape[1]),
+                          dtype=int)
+        counts[1:] = np.cumsum(occupied, axis=0)
+        columns = np.arange(self.classroom.width)
+
+        # number of students between each seat and its left and right aisle
+        count_left = np.where(
+            self.has_left_aisle[:, None],
+            counts[columns] - counts[self.left_aisle + 1], np.inf)
+        count_right = np.where(
+            self.has_right_aisle[:, None],
+            counts[self.right_aisle] - counts[columns + 1], np.inf)
+
+        return 1 - np.minimum(
+            count_right, count_left)/float(self.classroom.max_pass)
+
+    def get_social_utility(self, student_ids, xs, ys, occupancy=None):
+        """Get the social utility (friendship and sociability component) for
+        the given students at the given seat positions (see
+        Seat.get_social_utility).
+
+        Args:
+            student_ids: IDs of the students (scalar or one per position)
+            xs, ys: coordinates of the seats
+            occupancy: occupancy grid to use instead of the current one
+
+        Returns:
+            u_friendship: friendship components (in range [0,1])
+            u_sociability: sociability components (in range [0,1])
+
+        """
+        if occupancy is None:
+            occupancy = self.occupancy
+
+        interaction_x, interaction_y = (
+            self.friendship_interaction_matrix.shape)
+        to_center_x, to_center_y = int(interaction_x/2), int(interaction_y/2)
+        width, num_rows = self.shape
+
+        if np.ndim(student_ids) == 0:
+            # a single student, fetch its friendships only once
+            friends = self.get_friendship_row(student_ids)
+
+        student_ids = np.broadcast_to(student_ids, np.shape(xs))
+        sociabilities = self.sociabilities[student_ids]
+        u_friendship = np.zeros(np.shape(xs))
+        u_sociability = np.zeros(np.shape(xs))
+
+        for x in range(interaction_x):
+            for y in range(interaction_y):
+
+                # if there is a student check friendship (positions outside
+                # of the classroom are empty)
+                neighbor_xs = xs + x - to_center_x
+                neighbor_ys = ys + y - to_center_y
+                inside = ((neighbor_xs >= 0) & (neighbor_xs < width)
+                          & (neighbor_ys >= 0) & (neighbor_ys < num_rows))
+                neighbors = np.where(
+                    inside,
+                    occupancy[np.clip(neighbor_xs, 0, width - 1),
+                              np.clip(neighbor_ys, 0, num_rows - 1)],
+                    -1)
+                occupied = neighbors >= 0
+                friendship = np.zeros(np.shape(xs))
+                if student_ids.ndim == 0:
+                    friendship[occupied] = friends[neighbors[occupied]]
+                else:
+                    friendship[occupied] = self.get_friendships(
+                        student_ids[occupied], neighbors[occupied])
+
+                u_friendship += (self.friendship_interaction_matrix[x, y]
+                                 * friendship)
+
+                # unfamiliar neighbors contribute to the sociability component
+                strangers = occupied & (friendship == 0)
+                u_sociability[strangers] += (
+                    self.sociability_interaction_matrix[x, y]
+                    * sociabilities[strangers])
+
+        # scale the final sociability term to range [0,1]
+        s_min, s_max = self.sociability_range
+        if s_max > s_min:
+            u_sociability = np.maximum(0, u_sociability - s_min) / (s_max - s_min)
+        else:
+            u_sociability = np.full(np.shape(xs), s_min)
+
+        return u_friendship, u_sociability
+
+    def get_total_utility(self, student_id, xs, ys, occupancy=None):
+        """Get the overall utility of the given seats for the given student as a
+        linear combination of position, friendship, sociability and
+        accessibility components (see Seat.get_total_utility)."""
+        friendship_component, sociability_component = (
+            self.get_social_utility(student_id, xs, ys, occupancy))
+        coef_p, coef_f, coef_s, coef_a = self.coefs
+        return (coef_p * self.classroom.pos_utilities[xs, ys]
+                + coef_f * friendship_component
+                + coef_s * sociability_component
+                + coef_a * self.get_accessibility(xs, ys))
+
+    def get_seat_queue(self):
+        """Get the SeatQueue of the model, which is created on first use and
+        then kept up to date by seat_changed."""
+        if self.seat_queue is None:
+            self.seat_queue = SeatQueue(self)
+        return self.seat_queue
+
+    def seat_changed(self, pos):
+        """Update the SeatQueue (if in use) and mark the students that need to
+        reconsider their seats after the seat at the given position has been
+        taken or freed (and the accessibility of its row has been updated).
+
+        """
+        if self.seat_queue is not None:
+            self.seat_queue.update(*pos)
+
+        if self.moving_prob > 0:
+            # students within the interaction range or in the same row
+            x, y = pos
+            size_x, size_y = self.friendship_interaction_matrix.shape
+            to_center_x, to_center_y = int(size_x/2), int(size_y/2)
+            neighbors = self.occupancy[
+                max(x - to_center_x, 0):x + to_center_x + 1,
+                max(y - to_center_y, 0):y + to_center_y + 1]
+            for student_ids in (neighbors, self.occupancy[:, y]):
+                self.needs_evaluation[student_ids[student_ids >= 0]] = True
+
+            # the student who just took the seat has made its choice already
+            if self.occupancy[pos] >= 0:
+                self.needs_evaluation[self.occupancy[pos]] = False
+
+    def relocate(self):
+        """The relocation phase of a step: each student whose neighborhood or
+        row has changed since it last considered its seat looks for a better
+        seat with probability moving_prob (see choose_new_seat). Students are
+        processed in the order of their IDs. The decision to stay remains valid
+        until the situation around the student's seat changes again.
+
+        """
+        if self.moving_prob <= 0:
+            return
+
+        for student_id in np.flatnonzero(self.needs_evaluation):
+            if self.rand.uniform() < self.moving_prob:
+                self.needs_evaluation[student_id] = False
+                self.relocate_student(student_id)
+
+    def choose_new_seat(self, student_id):
+        """Decide if the given seated student moves to another seat.
+
+        The best empty seat is compared with the current seat of the student,
+        who does not count as neighbor of the empty seats. Leaving the current
+        seat costs the accessibility utility that is lost by passing the other
+        students in the row. The student moves if the remaining gain in utility
+        exceeds moving_threshold. Ties are broken randomly.
+
+        Args:
+            student_id: ID of the seated student
+
+        Returns:
+            seat_choice: flat index of the new seat (None if the student stays)
+
+        """
+        x, y = np.unravel_index(self.student_seats[student_id], self.shape)
+        seat_options = np.flatnonzero(self.seat_mask & (self.occupancy < 0))
+        if len(seat_options) == 0:
+            return None
+
+        occupancy = self.occupancy.copy()
+        occupancy[x, y] = -1
+        xs, ys = np.unravel_index(seat_options, self.shape)
+        seat_utilities = self.get_total_utility(student_id, xs, ys, occupancy)
+
+        current_utility = self.get_total_utility(
+            student_id, np.array([x]), np.array([y]))[0]
+        coef_a = self.coefs[3]
+        stand_up_cost = coef_a * (
+            1 - self.get_accessibility(np.array([x]), np.array([y]))[0])
+
+        best_utility = np.max(seat_utilities)
+        if (best_utility - stand_up_cost - current_utility
+                > self.moving_threshold):
+            return self.rand.choice(
+                seat_options[seat_utilities == best_utility])
+
+    def get_happiness(self, xs, ys, occupancy=None):
+        """Get the happiness of the students seated at the given positions
+        (total utility except for the accessibility component)."""
+        if occupancy is None:
+            occupancy = self.occupancy
+
+        friendship_component, sociability_component = (
+            self.get_social_utility(occupancy[xs, ys], xs, ys, occupancy))
+        coef_p, coef_f, coef_s, coef_a = self.coefs
+        return (coef_p * self.classroom.pos_utilities[xs, ys]
+                + coef_f * friendship_component
+                + coef_s * sociability_component)
+
+    def render_model_state(self, occupancy, accessibility):
+        """Create the image representation of a model state with information
+        about each seat and student (see ClassroomModel.get_model_state).
+
+        Args:
+            occupancy: (width x num_rows) matrix of student IDs
+            accessibility: (width x num_rows) matrix of seat accessibilities
+
+        """
+        image = -0.8*np.ones((self.classroom.num_rows, self.classroom.width))
+        info = np.zeros((self.classroom.num_rows, self.classroom.width, 4))
+
+        seat_xs, seat_ys = self.layout.seat_xs, self.layout.seat_ys
+        info[seat_ys, seat_xs, 0] = self.classroom.pos_utilities[
+            seat_xs, seat_ys]
+
+        # Available seats. Determine level of accessibility
+        xs, ys = np.nonzero(self.seat_mask & (occupancy < 0))
+        image[ys, xs] = -2 + accessibility[xs, ys]
+
+        # Occupied seats. Set value based on the student's happiness
+        xs, ys = np.nonzero(occupancy >= 0)
+        student_ids = occupancy[xs, ys]
+        image[ys, xs] = 1 + self.get_happiness(xs, ys, occupancy)
+
+        # save student's properties
+        info[ys, xs, 1] = student_ids
+        info[ys, xs, 2] = self.sociabilities[student_ids]
+        info[ys, xs, 3] = self.initial_happiness[student_ids]
+
+        for pos in self.classroom.entrances:
+            image[pos[1], pos[0]] = -3
+
+        return (image, info)
+
+    def remove_aisles(self, model_state):
+        """Remove aisles from the given matrix with shape of this model."""
+        # remove aisles from the matrix
+        model_state = np.delete(model_state, self.classroom.aisles_x, axis=0)
+        model_state = np.delete(model_state, self.classroom.aisles_y, axis=1)
+        return model_state
+
+
+class ClassroomModel(_ClassroomModelBase):
 
     """Create a classroom model
 
@@ -409,7 +1333,10 @@ class ClassroomModel():
 
         sociability_sequence: list of sociability values per student. Should be
         sampled from a probability distribution of the students' sociability
-        attribute social_network: the social network to use. Overrides
+        attribute
+
+        social_network: the social network to use, as dense or scipy.sparse
+        connectivity matrix. It is stored in CSR format. Overrides
         degree_sequence
 
         degree_sequence: list of friendship degrees per student. Used to create
@@ -426,88 +1353,101 @@ class ClassroomModel():
         deterministic_choice: boolean if students pick deterministically the
         seat with the highest utility, or if choice is probabilitstic.
 
+        choice_policy: the probabilistic seat choice, an object with a method
+        choose(rand, seat_options, seat_utilities), e.g. SoftmaxChoice.
+        Defaults to TopFractionChoice(seat_fraction)
+
+        moving_prob: probability per step that a seated student, whose
+        neighborhood or row changed since it last considered its seat, looks
+        for a better seat (see relocate). 0 disables the relocation phase.
+
+        moving_threshold: minimal utility gain (after the cost of standing up)
+        for which a student changes its seat
+
+        record_states: which model states are stored in model_states: "full"
+        (after every step), "final" (only after the last student is seated),
+        "none" or an integer N (every N steps). Any state can still be
+        reconstructed from the seating events with get_model_state_at.
+
     """
     def __init__(self, classroom_design, coefs=[0.25, 0.25, 0.25, 0.25],
                  sociability_sequence=None, social_network=None,
                  degree_sequence=None, seed=0,
-                 seat_fraction=0.5, deterministic_choice=True, scale=True):
-        self.rand = np.random.RandomState(seed)
-        self.classroom = classroom_design
-        self.seat_fraction = seat_fraction
-        self.deterministic_choice = deterministic_choice
+                 seat_fraction=0.5, deterministic_choice=True, scale=True,
+                 record_states="full", choice_policy=None, moving_prob=0,
+                 moving_threshold=0.1):
+        super().__init__(classroom_design, coefs, sociability_sequence,
+                         social_network, degree_sequence, seed, seat_fraction,
+                         deterministic_choice, scale, record_states,
+                         choice_policy, moving_prob, moving_threshold)
+
+    @property
+    def num_students(self):
+        """Number of students that have arrived so far."""
+        return len(self.students)
+
+    def reset(self, seed=0):
+        """Bring the model into its initial state, using the given seed (see
+        _ClassroomModelBase.reset). All seats are empty again."""
+        super().reset(seed)
         self.empty_seats = []
         self.students = []
-        self.model_states = []   # all simulated model states stored here
-        self.im = None   # used to store the current image
 
         # Referenced as x, y (i.e. column then row!)
         self.seats = np.empty(
             (self.classroom.width, self.classroom.num_rows), dtype=Seat)
 
-        # Assure that the coefficients sum up to one
-        if scale:
-            self.coefs = [(c/sum(coefs) if sum(coefs) > 0 else 0)
-                          for c in coefs]
-        else:
-            self.coefs = coefs
+        # Occupancy prefix counts per row: row_counts[y, i] is the number of
+        # students seated in row y left of column i
+        self.row_counts = np.zeros(
+            (self.classroom.num_rows, self.classroom.width + 1), dtype=int)
 
-        # If all utility components are set to zero, seat choices are
-        # completely random
-        self.random_seat_choice = np.all(coefs == 0)
+        # initialize seats (leave aisles free), ordered by column and row
+        for x, y in zip(self.layout.seat_xs.tolist(),
+                        self.layout.seat_ys.tolist()):
+            # create new seat
+            seat = Seat(self, (x, y))
+            self.empty_seats.append(seat)
+            self.seats[x, y] = seat
 
-        # Setup the social network
-        if social_network is not None:
-            self.social_network = social_network
-            self.max_num_agents = social_network.shape[0]
-        else:
-            if degree_sequence is None:
-                # create a random network
-                self.max_num_agents = self.classroom.seat_count
-                self.social_network = network.erdos_renyi(self.max_num_agents, 0.2)[0]
-            else:
-                self.max_num_agents = len(degree_sequence)
-                self.rand.shuffle(degree_sequence)
-                self.social_network = network.walts_graph(
-                    degree_sequence, plot=False)[0]
+        self.record_model_state()
 
-        # set up the sociabilities of the students
-        if sociability_sequence is None:
-            # default sociability values are sampled uniformly from [0,1]
-            self.sociability_sequence = deque(
-                [self.rand.uniform(0, 1) for _ in range(self.max_num_agents)])
-            self.sociability_range = (min(self.sociability_sequence),
-                                      max(self.sociability_sequence))
-        else:
-            if len(sociability_sequence) == self.max_num_agents:
-                self.rand.shuffle(sociability_sequence)
-                self.sociability_sequence = deque(sociability_sequence)
-                self.sociability_range = (min(self.sociability_sequence),
-                                          max(self.sociability_sequence))
-            else:
-                raise ValueError("'sociability_sequence' and 'degree_sequence' must have same length")
+    def restore(self, snapshot):
+        """Bring the model into the state of the given snapshot (see
+        _ClassroomModelBase.fork). The students and seats are recreated from
+        the state matrices of the snapshot."""
+        super().restore(snapshot)
 
-        # Matrices that determine the importance of neighboring seats for the
-        # social utility. They need to have the same shape. Values should sum
-        # up to one so that the resulting friendship and sociability terms are
-        # within range [0,1].
-        self.friendship_interaction_matrix = np.array([[0.5, 0, 0.5]]).T
-        self.sociability_interaction_matrix = np.array([[0.5, 0, 0.5]]).T
+        self.students = []
+        for n in range(snapshot.num_students):
+            student = Student(n, self, self.sociabilities[n])
+            student.initial_happiness = self.initial_happiness[n]
+            self.students.append(student)
 
-        # initialize seats (leave aisles free)
-        for x in range(self.classroom.width):
-            if x not in self.classroom.aisles_x:
-                for y in range(self.classroom.num_rows):
-                    if y not in self.classroom.aisles_y:
-                        # create new seat
-                        seat = Seat(self, (x, y))
-                        self.empty_seats.append(seat)
-                        self.seats[x, y] = seat
+        self.empty_seats = []
+        self.seats = np.empty(
+            (self.classroom.width, self.classroom.num_rows), dtype=Seat)
+        for x, y in zip(self.layout.seat_xs.tolist(),
+                        self.layout.seat_ys.tolist()):
+            seat = Seat(self, (x, y))
+            seat.accessibility = snapshot.accessibility[x, y]
+            student_id = self.occupancy[x, y]
+            if student_id >= 0:
+                seat.student = self.students[student_id]
+                seat.student.seated = True
+                seat.student.seat = seat
+            else:
+                self.empty_seats.append(seat)
+            self.seats[x, y] = seat
 
-        self.model_states.append(self.get_model_state())
+        self.row_counts = np.zeros(
+            (self.classroom.num_rows, self.classroom.width + 1), dtype=int)
+        self.row_counts[:, 1:] = np.cumsum(self.occupancy >= 0, axis=0).T
 
     def step(self):
         """Advance the model by one step. If the maximum student number is not reached
-        yet, create a new student every tick.
+        yet, create a new student every tick. Afterwards, seated students may
+        change their seats (see relocate).
 
         """
         # As long as the max number of students is not reached, add a new one
@@ -520,12 +1460,22 @@ class ClassroomModel():
                 sociability = 0
 
             student = Student(n, self, sociability)
+            self.sociabilities[n] = sociability
+            self.num_steps += 1
 
             # add student and update
             self.students.append(student)
             student.step()
 
-            self.model_states.append(self.get_model_state())
+        elif self.moving_prob > 0:
+            # all students are seated, but they may still change seats
+            self.num_steps += 1
+
+        else:
+            return
+
+        self.relocate()
+        self.record_model_state()
 
     def step_predetermined_seating(self, seat_pos):
         """Advance the model by one step. If the maximum student number is not reached
@@ -540,10 +1490,109 @@ class ClassroomModel():
             # if max student count is not reached, create student
             student = Student(n, self)
             self.students.append(student)
+            self.num_steps += 1
 
             # place new student at the predetermined seat
             student.choose_seat(seat_pos)
 
+    def update_occupancy(self, seat):
+        """Update the occupancy grid, the row prefix counts and the cached
+        neighborhoods after the given seat has been taken or freed.
+
+        Args:
+            seat: the Seat that changed
+
+        """
+        if seat.student is None:
+            self.occupancy[seat.pos] = -1
+            self.update_row_counts(seat.pos, -1)
+        else:
+            self.occupancy[seat.pos] = seat.student.unique_id
+            self.update_row_counts(seat.pos, 1)
+            self.log_seating(seat.student.unique_id, seat.pos)
+        self.invalidate_neighborhoods(seat.pos)
+
+    def get_social_utilities(self, student):
+        """Get the social utility of all seats for the given student at once.
+
+        The friendship values of the student towards all seated students and
+        the sociability values for all unfamiliar seated students are arranged
+        in grids, which are correlated with the interaction matrices. The
+        results are identical to Seat.get_social_utility.
+
+        Args:
+            student: the student making the seating choice
+
+        Returns:
+            u_friendship: (width x num_rows) matrix of friendship components
+            u_sociability: (width x num_rows) matrix of sociability components
+
+        """
+        occupied = self.occupancy >= 0
+        friends = self.get_friendship_row(int(student.unique_id))
+
+        friendship = np.where(occupied, friends[self.occupancy], 0)
+        strangers = occupied & (friendship == 0)
+
+        u_friendship = correlate_interaction(
+            friendship, self.friendship_interaction_matrix)
+        u_sociability = correlate_interaction(
+            np.where(strangers, student.sociability, 0),
+            self.sociability_interaction_matrix)
+
+        # scale the final sociability term to range [0,1]
+        s_min, s_max = self.sociability_range
+        if s_max > s_min:
+            u_sociability = np.maximum(0, u_sociability - s_min) / (s_max - s_min)
+        else:
+            u_sociability = np.full(u_sociability.shape, s_min)
+
+        return u_friendship, u_sociability
+
+    def relocate_student(self, student_id):
+        """Let the given seated student reconsider its seat."""
+        self.students[student_id].step()
+
+    def get_accessibility(self, xs, ys):
+        """Get the accessibility of the seats at the given positions."""
+        return np.array([self.seats[x, y].accessibility
+                         for x, y in zip(xs, ys)], dtype=float)
+
+    def update_row_counts(self, pos, change):
+        """Update the occupancy prefix counts of the row after a seat has been
+        taken (change=1) or freed (change=-1).
+
+        Args:
+            pos: the (x, y) coordinates of the seat that changed
+            change: change in the number of students at this position
+
+        """
+        x, y = pos
+        self.row_counts[y, x+1:] += change
+
+    def invalidate_neighborhoods(self, pos):
+        """Reset the cached neighbors of all seats whose interaction range
+        includes the given position. Needs to be called whenever the seat at
+        this position is taken or freed.
+
+        Args:
+            pos: the (x, y) coordinates of the seat that changed
+
+        """
+        interaction_x, interaction_y = self.friendship_interaction_matrix.shape
+        to_center_x, to_center_y = int(interaction_x/2), int(interaction_y/2)
+        x, y = pos
+
+        for i in range(interaction_x):
+            for j in range(interaction_y):
+                coords = (x - i + to_center_x, y - j + to_center_y)
+
+                if (0 <= coords[0] < self.classroom.width
+                        and 0 <= coords[1] < self.classroom.num_rows):
+                    seat = self.seats[coords]
+                    if seat is not None:
+                        seat.occupied_neighbors = None
+
     """
     Returns the current model state, with information about each seat and
     student
@@ -603,13 +1652,6 @@ class ClassroomModel():
                 model_state[seat.pos] = seat.get_happiness(seat.student)
         return self.remove_aisles(model_state).T
 
-    def remove_aisles(self, model_state):
-        """Remove aisles from the given matrix with shape of this model."""
-        # remove aisles from the matrix
-        model_state = np.delete(model_state, self.classroom.aisles_x, axis=0)
-        model_state = np.delete(model_state, self.classroom.aisles_y, axis=1)
-        return model_state
-
     def plot(self, fig, ax, interactive=False, state=-1):
         """Using matplotlib to draw the current state of the model.
 
@@ -620,10 +1662,14 @@ class ClassroomModel():
             state: which model state to use. -1 can be used to show last state.
 
         """
-        try:
-            image, info = self.model_states[state]
-        except:
-            image, info = self.get_model_state()
+        if self.record_states == "full":
+            try:
+                image, info = self.model_states[state]
+            except:
+                image, info = self.get_model_state()
+        else:
+            # the state has not been recorded, reconstruct it instead
+            image, info = self.get_model_state_at(min(state, self.num_steps))
 
         ax.clear()
 
@@ -688,6 +1734,348 @@ class ClassroomModel():
         fig.tight_layout(rect=[0, 0.2, 1, 1])
 
 
+class ArrayClassroomModel(_ClassroomModelBase):
+
+    """Create a classroom model whose state is entirely stored in NumPy arrays.
+
+    Instead of Seat and Student objects the model keeps an occupancy grid of
+    student IDs, an accessibility grid, the position utilities of the
+    classroom design and one vector per student attribute. Seat utilities are
+    evaluated for all empty seats at once. Given the same arguments, the
+    random numbers are consumed exactly as in ClassroomModel, so both models
+    produce the same seating decisions.
+
+    Args: see ClassroomModel
+
+    """
+    def __init__(self, classroom_design, coefs=[0.25, 0.25, 0.25, 0.25],
+                 sociability_sequence=None, social_network=None,
+                 degree_sequence=None, seed=0,
+                 seat_fraction=0.5, deterministic_choice=True, scale=True,
+                 record_states="full", choice_policy=None, moving_prob=0,
+                 moving_threshold=0.1):
+        super().__init__(classroom_design, coefs, sociability_sequence,
+                         social_network, degree_sequence, seed, seat_fraction,
+                         deterministic_choice, scale, record_states,
+                         choice_policy, moving_prob, moving_threshold)
+
+    def reset(self, seed=0):
+        """Bring the model into its initial state, using the given seed (see
+        _ClassroomModelBase.reset). All seats are empty again."""
+        super().reset(seed)
+        self.num_students = 0
+
+        # accessibility of each seat (see update_accessibility)
+        self.accessibility = np.ones(self.shape)
+
+        self.record_model_state()
+
+    def restore(self, snapshot):
+        """Bring the model into the state of the given snapshot (see
+        _ClassroomModelBase.fork)."""
+        super().restore(snapshot)
+        self.num_students = snapshot.num_students
+        self.accessibility = snapshot.accessibility.copy()
+
+    def get_empty_seats(self):
+        """Get the flat indices of all empty seats, ordered by column and then
+        by row as in ClassroomModel.empty_seats."""
+        return np.flatnonzero(self.seat_mask & (self.occupancy < 0))
+
+    def update_accessibility(self, y):
+        """Update the accessibility of all seats in row y based on the number of
+        students between each seat and the aisles (see
+        Seat.update_accessibility).
+
+        """
+        self.accessibility[:, y] = self.get_accessibility_grid(
+            self.occupancy[:, y:y+1])[:, 0]
+
+    def get_accessibility(self, xs, ys):
+        """Get the accessibility of the seats at the given positions."""
+        return self.accessibility[xs, ys]
+
+    def choose_seat(self, student_id, seat_pos=None, seat_utilities=None):
+        """The seat selection procedure of the given student (see
+        Student.choose_seat).
+
+        Args:
+            student_id: ID of the student making the seating decision
+            seat_pos: predetermined position of the seat to choose. If this
+                parameter is specified utilities are ignored.
+            seat_utilities: precomputed (width x num_rows) matrix of the
+                total utilities of all seats for this student (see
+                BatchClassroomModel). If not given, the utilities of the empty
+                seats are determined by get_total_utility.
+
+        """
+        seat_choice = None
+
+        if seat_pos is None:
+            # Determine all possible seats to choose from
+            seat_options = self.get_empty_seats()
+
+            if len(seat_options) == 0:
+                print("No empty seats!")
+
+            elif self.random_seat_choice:
+                # Pick one randomly
+                seat_choice = self.rand.choice(seat_options)
+
+            else:
+                if seat_utilities is None:
+                    xs, ys = np.unravel_index(seat_options, self.shape)
+                    seat_utilities = self.get_total_utility(student_id, xs, ys)
+                else:
+                    seat_utilities = seat_utilities.ravel()[seat_options]
+
+                if self.deterministic_choice:
+                    # Always choose among the seats with highest utility
+                    seat_choice = self.rand.choice(seat_options[
+                        seat_utilities == np.max(seat_utilities)])
+
+                else:
+                    # Choose probabilistically based on the utilities (e.g.
+                    # among the best 'seat_fraction' of all available seats)
+                    seat_choice = self.choice_policy.choose(
+                        self.rand, seat_options, seat_utilities)
+
+        elif self.seat_mask[seat_pos] and self.occupancy[seat_pos] < 0:
+            seat_choice = np.ravel_multi_index(seat_pos, self.shape)
+
+        if seat_choice is not None:
+            # move to the selected seat
+            x, y = np.unravel_index(seat_choice, self.shape)
+            self.occupancy[x, y] = student_id
+            self.log_seating(student_id, (x, y))
+            self.initial_happiness[student_id] = self.get_happiness(x, y)
+
+            # update the accessibility of all seats in the row
+            self.update_accessibility(y)
+            self.seat_changed((x, y))
+
+    def step(self):
+        """Advance the model by one step. If the maximum student number is not reached
+        yet, create a new student every tick. Afterwards, seated students may
+        change their seats (see relocate).
+
+        """
+        # As long as the max number of students is not reached, add a new one
+        n = self.add_student()
+        if n is not None:
+            self.choose_seat(n)
+
+        elif self.moving_prob > 0:
+            # all students are seated, but they may still change seats
+            self.num_steps += 1
+
+        else:
+            return
+
+        self.relocate()
+        self.record_model_state()
+
+    def relocate_student(self, student_id):
+        """Let the given seated student reconsider its seat (see
+        Student.choose_seat)."""
+        seat_index = self.choose_new_seat(student_id)
+        if seat_index is not None:
+            # make seat available again
+            x, y = np.unravel_index(self.student_seats[student_id], self.shape)
+            self.occupancy[x, y] = -1
+            self.update_accessibility(y)
+            self.seat_changed((x, y))
+
+            self.choose_seat(student_id,
+                             np.unravel_index(seat_index, self.shape))
+
+    def add_student(self):
+        """Create the next student if the maximum student number is not reached
+        yet.
+
+        Returns:
+            student_id: ID of the new student (None if no student was added)
+
+        """
+        n = self.num_students
+        if n < self.max_num_agents:
+            # create student
+            try:
+                sociability = self.sociability_sequence.popleft()
+            except:
+                sociability = 0
+
+            self.sociabilities[n] = sociability
+            self.num_students += 1
+            self.num_steps += 1
+            return n
+
+    def step_predetermined_seating(self, seat_pos):
+        """Advance the model by one step. If the maximum student number is not reached
+        yet, create a new student and place him at the given position.
+
+        Args:
+            seat_pos: position at which the new student should be seated
+
+        """
+        n = self.num_students
+        if n < self.max_num_agents:
+            # if max student count is not reached, create student
+            self.num_students += 1
+            self.num_steps += 1
+
+            # place new student at the predetermined seat
+            self.choose_seat(n, seat_pos)
+
+    def get_model_state(self):
+        """Returns the current model state, with information about each seat and
+        student (see ClassroomModel.get_model_state)."""
+        return self.render_model_state(self.occupancy, self.accessibility)
+
+    def get_binary_model_state(self):
+        """Get the current seating distribution in the classroom. Ones represent
+        students, zeros represent available seats. Aisles are stripped.
+
+        Returns:
+
+            model_state: binary matrix where each entry refers to a seat's
+                state
+
+        """
+        model_state = (self.occupancy >= 0).astype(int)
+        return self.remove_aisles(model_state).T
+
+    def get_happiness_model_state(self):
+        """Return a matrix of the happiness of each student at each seat."""
+        model_state = np.zeros(self.shape)
+        xs, ys = np.nonzero(self.occupancy >= 0)
+        model_state[xs, ys] = self.get_happiness(xs, ys)
+        return self.remove_aisles(model_state).T
+
+
+class BatchClassroomModel():
+
+    """Simulate several replicates of the same model configuration at once.
+
+    The replicates are ArrayClassroomModels that only differ in their seeds
+    (and therefore in their social networks, shuffled sequences and seat
+    choices), e.g. created by run_model.init_default_batch_model. Their
+    occupancy and accessibility grids are stacked into (R x width x num_rows)
+    arrays and the seat utilities of all replicates are evaluated together.
+    Every replicate keeps its own random number generator, so the results are
+    identical to running the replicates one after another.
+
+    Args:
+        models: list of ArrayClassroomModels with the same classroom design,
+            coefficients and number of students
+
+    """
+    def __init__(self, models):
+        self.models = models
+        model = models[0]
+
+        for m in models:
+            if (m.shape != model.shape or list(m.coefs) != list(model.coefs)
+                    or m.max_num_agents != model.max_num_agents
+                    or m.num_students != model.num_students):
+                raise ValueError("All replicates must share the same configuration and state")
+
+        self.classroom = model.classroom
+        self.coefs = model.coefs
+        self.max_num_agents = model.max_num_agents
+        self.friendship_interaction_matrix = model.friendship_interaction_matrix
+        self.sociability_interaction_matrix = (
+            model.sociability_interaction_matrix)
+
+        # Stack the replicate states and let the replicates work on views of
+        # the stacked arrays
+        self.occupancy = np.stack([m.occupancy for m in models])
+        self.accessibility = np.stack([m.accessibility for m in models])
+        for r, m in enumerate(models):
+            m.occupancy = self.occupancy[r]
+            m.accessibility = self.accessibility[r]
+
+        s_min, s_max = np.array([m.sociability_range for m in models]).T
+        self.s_min = s_min[:, None, None]
+        self.s_max = s_max[:, None, None]
+
+    def get_total_utilities(self, student_id):
+        """Get the total utility of all seats for the student with the given ID
+        in all replicates (see ArrayClassroomModel.get_total_utility).
+
+        Returns:
+            total_utility: (R x width x num_rows) array
+
+        """
+        occupied = self.occupancy >= 0
+
+        # friendship values of the student towards all seated students
+        friends = np.stack(
+            [m.get_friendship_row(student_id) for m in self.models])
+        friendship = np.take_along_axis(
+            friends, np.maximum(self.occupancy, 0).reshape(len(friends), -1),
+            axis=1).reshape(self.occupancy.shape)
+        friendship = np.where(occupied, friendship, 0)
+        strangers = occupied & (friendship == 0)
+
+        sociabilities = np.array(
+            [m.sociabilities[student_id] for m in self.models])[:, None, None]
+
+        u_friendship = correlate_interaction(
+            friendship, self.friendship_interaction_matrix)
+        u_sociability = correlate_interaction(
+            np.where(strangers, sociabilities, 0),
+            self.sociability_interaction_matrix)
+
+        # scale the final sociability term to range [0,1]
+        scalable = self.s_max > self.s_min
+        u_sociability = np.where(
+            scalable,
+            np.maximum(0, u_sociability - self.s_min)
+            / np.where(scalable, self.s_max - self.s_min, 1),
+            self.s_min)
+
+        coef_p, coef_f, coef_s, coef_a = self.coefs
+        return (coef_p * self.classroom.pos_utilities
+                + coef_f * u_friendship
+                + coef_s * u_sociability
+                + coef_a * self.accessibility)
+
+    def step(self):
+        """Advance all replicates by one step."""
+        student_ids = [m.add_student() for m in self.models]
+
+        if student_ids[0] is None or self.models[0].random_seat_choice:
+            seat_utilities = [None] * len(self.models)
+        else:
+            seat_utilities = self.get_total_utilities(student_ids[0])
+
+        for m, student_id, utilities in zip(
+                self.models, student_ids, seat_utilities):
+            if student_id is not None:
+                m.choose_seat(student_id, seat_utilities=utilities)
+
+            elif m.moving_prob > 0:
+                # all students are seated, but they may still change seats
+                m.num_steps += 1
+
+            else:
+                continue
+
+            m.relocate()
+            m.record_model_state()
+
+    def get_binary_model_state(self):
+        """Get the seating distributions of all replicates as (R x rows x
+        columns) array (see ClassroomModel.get_binary_model_state)."""
+        return np.array([m.get_binary_model_state() for m in self.models])
+
+    def get_happiness_model_state(self):
+        """Get the happiness matrices of all replicates as (R x rows x columns)
+        array."""
+        return np.array([m.get_happiness_model_state() for m in self.models])
+
+
 class ClassroomDesign():
     """Create a classroom layout composed of aisles and entrances
 
@@ -779,3 +2167,104 @@ class ClassroomDesign():
 
         # determine the total number of seats
         self.seat_count = (self.width - len(self.aisles_x)) * (self.num_rows - len(self.aisles_y))
+
+        # compact index of the layout, created on first use
+        self.layout_index = None
+
+    def get_layout_index(self):
+        """Get the LayoutIndex of the design. It is computed once and shared by
+        all models built from this design.
+
+        Returns:
+            layout_index: LayoutIndex instance
+
+        """
+        if self.layout_index is None:
+            self.layout_index = LayoutIndex(self)
+        return self.layout_index
+
+
+class LayoutIndex():
+    """Precomputed integer arrays describing a ClassroomDesign, used by the
+    models instead of looking up the aisle lists of the design. The arrays are
+    read-only, as they are shared by all models of the same design.
+
+    Args:
+
+        classroom: the ClassroomDesign to describe
+
+    Attributes:
+
+        seat_mask: (width x num_rows) boolean matrix, True for seats
+
+        seat_xs, seat_ys: coordinates of all seats, ordered by column and then
+        by row
+
+        left_aisle, right_aisle: column of the nearest aisle to the left and
+        right of each column. Columns without an aisle on one side get a
+        placeholder (0 or width) and are flagged in has_left_aisle and
+        has_right_aisle
+
+    """
+    def __init__(self, classroom):
+        width, num_rows = classroom.width, classroom.num_rows
+        aisles_x = np.array(classroom.aisles_x, dtype=int)
+        columns = np.arange(width)
+
+        is_aisle_x = np.isin(columns, aisles_x)
+        is_aisle_y = np.isin(np.arange(num_rows), classroom.aisles_y)
+        self.seat_mask = ~is_aisle_x[:, None] & ~is_aisle_y[None, :]
+        self.seat_xs, self.seat_ys = np.nonzero(self.seat_mask)
+
+        if len(aisles_x) > 0:
+            self.has_left_aisle = columns > aisles_x[0]
+            self.has_right_aisle = columns < aisles_x[-1]
+        else:
+            self.has_left_aisle = np.zeros(width, dtype=bool)
+            self.has_right_aisle = np.zeros(width, dtype=bool)
+            aisles_x = np.zeros(1, dtype=int)
+        self.left_aisle = np.where(
+            self.has_left_aisle,
+            aisles_x[np.maximum(np.searchsorted(aisles_x, columns) - 1, 0)],
+            0)
+        self.right_aisle = np.where(
+            self.has_right_aisle,
+            aisles_x[np.minimum(np.searchsorted(aisles_x, columns, 'right'),
+                                len(aisles_x) - 1)],
+            width)
+
+        for array in (self.seat_mask, self.seat_xs, self.seat_ys,
+                      self.has_left_aisle, self.has_right_aisle,
+                      self.left_aisle, self.right_aisle):
+            array.flags.writeable = False
+
+        # plain lists for fast scalar lookups (see Seat)
+        self.left_aisle_list = self.left_aisle.tolist()
+        self.right_aisle_list = self.right_aisle.tolist()
+
+        self.shape = (width, num_rows)
+        self.neighbor_offsets = {}
+
+    def get_neighbor_offsets(self, size_x, size_y):
+        """Get the offsets of the positions covered by an interaction matrix of
+        the given shape, centered at a seat.
+
+        Returns:
+            offsets_x, offsets_y: offsets in x and y direction, in the order
+                of the entries of the interaction matrix
+            flat_offsets: the corresponding offsets of flat indices into
+                (width x num_rows) matrices. Only valid if the shifted position
+                lies within the classroom
+
+        """
+        if (size_x, size_y) not in self.neighbor_offsets:
+            offsets_x, offsets_y = np.meshgrid(
+                np.arange(size_x) - int(size_x/2),
+                np.arange(size_y) - int(size_y/2), indexing='ij')
+            offsets_x, offsets_y = offsets_x.ravel(), offsets_y.ravel()
+            flat_offsets = offsets_x * self.shape[1] + offsets_y
+            for array in (offsets_x, offsets_y, flat_offsets):
+                array.flags.writeable = False
+            self.neighbor_offsets[(size_x, size_y)] = (
+                offsets_x, offsets_y, flat_offsets)
+        return self.neighbor_offsets[(size_x, size_y)]
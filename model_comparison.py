@@ -1,13 +1,23 @@
+import collections
+import hashlib
+import multiprocessing
 import numpy as np
 import pickle as pkl
 import matplotlib.pyplot as plt
 from model import *
 from run_model import *
 from skimage.measure import shannon_entropy
-from skimage.feature import greycomatrix, greycoprops
 
 _compare_dict = {'lbp': 0, 'cluster': 1, 'entropy': 2}
 
+# Profiles of target seating distributions by content (see get_target_profile),
+# the least recently used first
+_target_profiles = collections.OrderedDict()
+TARGET_PROFILE_CACHE_SIZE = 64
+
+# Profiles of a worker process computing distances (see init_distance_worker)
+_distance_inputs = None
+
 
 """
 This is an adjusted version of Arran's 'utils.py'
@@ -35,25 +45,64 @@ Returns:
     i lengthed groups, up to the max possible length defined by the aisles
 """
 def count_clusters(model_state, aisles=[6]):
-    # where the final counts will be stored
-    counts = np.zeros(model_state.shape[1] + 1)
+    return RunLengths(model_state, aisles).counts
 
-    for row in model_state:
-        # split the row into blocks and iterate over the seats
-        for block in np.split(row, aisles):
-            c = 0
-            for seat in block:
-                if seat == 1:
-                    c += 1
-                else:
-                    counts[c] += 1
-                    c = 0
-            counts[c] += 1
 
-    # the value at i = 0 will be non-sensical, so set to 0
-    counts[0] = 0
+"""
+Run-length encoding of the horizontal groups of seated students (see
+count_clusters), from which all run-length features are derived. The runs are
+found at once for all rows (and states) by the changes between neighboring
+seats. The blocks between aisles are separated by empty seats, so that an
+aisle ends a group.
+
+Args:
+    model_states: seating distribution as a binary matrix of seats, or a stack
+        of R binary matrices (R x H x W)
+    aisles: A list of vertical aisles.
 
-    return counts
+Attributes:
+    counts: the counts of count_clusters, a (R x W+1) array for a stack
+"""
+class RunLengths():
+
+    def __init__(self, model_states, aisles=[6]):
+        states = np.asarray(model_states) == 1
+        single = states.ndim == 2
+        if single:
+            states = states[np.newaxis]
+        num_states, height, width = states.shape
+
+        # the blocks between the aisles (as split by np.split), each preceded
+        # and followed by an empty seat
+        bounds = [0] + list(aisles) + [width]
+        empty = np.zeros((num_states, height, 1), dtype=np.int8)
+        blocks = [empty]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            blocks += [states[:, :, start:end].astype(np.int8), empty]
+        changes = np.diff(np.concatenate(blocks, axis=2), axis=2)
+
+        # each row begins and ends with an empty seat, so the i-th start of a
+        # group belongs to the i-th end
+        starts = np.flatnonzero(changes == 1)
+        lengths = np.flatnonzero(changes == -1) - starts
+        state_ids = starts // changes[0].size
+
+        counts = np.bincount(state_ids * (width + 1) + lengths,
+                             minlength=num_states * (width + 1))
+        counts = counts.reshape(num_states, width + 1).astype(float)
+        self.counts = counts[0] if single else counts
+
+    # Run-length non-uniformity: the sum of squared counts per run.
+    def nonuniformity(self):
+        num_runs = self.counts.sum(axis=-1)
+        return (self.counts**2).sum(axis=-1) / num_runs
+
+    # Long run emphasis: the squared run lengths weighted by their counts, per
+    # run.
+    def long_run_emphasis(self):
+        num_runs = self.counts.sum(axis=-1)
+        lengths = np.arange(self.counts.shape[-1])
+        return (self.counts * lengths**2).sum(axis=-1) / num_runs
 
 
 """
@@ -72,27 +121,39 @@ Returns:
     each uniquley defined LBP
 """
 def count_lbp(model_state):
+    return count_lbp_batch(np.asarray(model_state)[np.newaxis])[0]
+
+
+"""
+Like count_lbp, but for a stack of seating distributions at once.
+
+Args:
+    model_states: (R x H x W) array of R binary seating distributions
+
+Returns:
+    A (R x 256) array with the LBP counts of each seating distribution
+"""
+def count_lbp_batch(model_states):
+    model_states = np.asarray(model_states).astype(np.int64)
+    num_states, height, width = model_states.shape
+
     # the relative coordinates in sequence in order to traverse around the
     # seat so to build up the binary representation of the seat's 8 neighbors
     i_deltas = [-1, -1, -1, 0, 1, 1, 1, 0]
     j_deltas = [-1, 0, 1, 1, 1, 0, -1, -1]
 
+    # decimal representation of surrounding seats for all seats except the
+    # outer edges, the k-th neighbor sets bit k
+    codes = np.zeros((num_states, max(height - 2, 0), max(width - 2, 0)),
+                     dtype=np.int64)
+    for k, (i_d, j_d) in enumerate(zip(i_deltas, j_deltas)):
+        codes |= model_states[:, 1+i_d:height-1+i_d, 1+j_d:width-1+j_d] << k
 
-    # where the final counts will be stored
-    counts = np.zeros(256)
-
-    # iterate over all seats except the outer edges
-    for i in np.arange(1, model_state.shape[0] - 1):
-        for j in np.arange(1, model_state.shape[1] - 1):
-            # decimal representation of surrounding seats
-            dec = 0
-            for k, (i_d, j_d) in enumerate(zip(i_deltas, j_deltas)):
-                dec += model_state[i+i_d][j+j_d] * 2**k
-
-            # increase the count for this LBP
-            counts[int(dec)] += 1
+    # count the LBPs of each state separately
+    codes += 256 * np.arange(num_states)[:, np.newaxis, np.newaxis]
+    counts = np.bincount(codes.ravel(), minlength=256 * num_states)
 
-    return counts
+    return counts.reshape(num_states, 256).astype(float)
 
 
 """
@@ -109,34 +170,133 @@ Returns:
     length.
 """
 def get_entropy(model_state):
-    entropies = []
-    height, width = model_state.shape
+    return list(get_entropy_batch(np.asarray(model_state)[np.newaxis])[0])
 
-    for k in range(1, min(height, width) + 1):
-        matrix_k = np.zeros([height - k + 1, width - k + 1])
 
-        # slide k by k window over model state and take the mean
-        for (row, col), val in np.ndenumerate(model_state):
-            if not ((row > (height - k)) or (col > (width - k))):
-                sub_matrix = np.zeros((k, k))
+"""
+Like get_entropy, but for a stack of seating distributions at once. The means
+of all k by k windows are computed from one summed-area table (exact for
+binary seating distributions).
 
-                for i in range(k):
-                    for j in range(k):
-                        sub_matrix[i, j] = model_state[row+i, col+j]
+Args:
+    model_states: (R x H x W) array of R seating distributions
+
+Returns:
+    A (R x min(H, W)) array with the entropy profile of each seating
+    distribution
+"""
+def get_entropy_batch(model_states):
+    model_states = np.asarray(model_states)
+    num_states, height, width = model_states.shape
+
+    # the sums of integer seat values are exact, those of binary seat values
+    # range from 0 to k * k
+    binary = np.all((model_states == 0) | (model_states == 1))
+    if np.array_equal(model_states, np.round(model_states)):
+        model_states = model_states.astype(np.int64)
+    else:
+        model_states = model_states.astype(float)
 
-                matrix_k[row, col] = sub_matrix.mean()
+    # summed-area table: table[:, i, j] is the sum of all seats above and left
+    # of (i, j)
+    table = np.zeros((num_states, height + 1, width + 1),
+                     dtype=model_states.dtype)
+    table[:, 1:, 1:] = model_states.cumsum(axis=1).cumsum(axis=2)
 
-        # calculate entropy for this sub matrix by generating a discrete
-        # distribution of values and their frequencies
-        unique, counts = np.unique(matrix_k, return_counts=True)
-        total = sum(counts)
-        dist = np.array([x / total for x in counts])
-        entropy = -sum(dist * np.log2(dist))
-        entropies.append(entropy)
+    entropies = np.empty((num_states, min(height, width)))
+    for k in range(1, min(height, width) + 1):
+        # sum of each k by k window
+        sums_k = (table[:, k:, k:] - table[:, :-k, k:] - table[:, k:, :-k]
+                  + table[:, :-k, :-k])
+
+        # calculate entropy for each state by generating a discrete
+        # distribution of values and their frequencies (summed up one after
+        # another, values that do not occur add zeros)
+        if binary:
+            # count the window sums of all states at once
+            offsets = (k * k + 1) * np.arange(num_states)[:, np.newaxis, np.newaxis]
+            counts = np.bincount((sums_k + offsets).ravel(),
+                                 minlength=num_states * (k * k + 1))
+            counts = counts.reshape(num_states, k * k + 1)
+            dist = counts / counts.sum(axis=1, keepdims=True)
+            terms = dist * np.log2(np.where(counts > 0, dist, 1))
+            entropies[:, k - 1] = -np.cumsum(terms, axis=1)[:, -1]
+        else:
+            matrix_k = sums_k / (k * k)
+            for r in range(num_states):
+                unique, counts = np.unique(matrix_k[r], return_counts=True)
+                dist = counts / counts.sum()
+                entropies[r, k - 1] = -np.cumsum(dist * np.log2(dist))[-1]
 
     return entropies
 
 
+"""
+Grey-level co-occurrence matrices (GLCM) of horizontal seat pairs with distance
+1 for a stack of binary seating distributions. The pairs are counted directly
+for the two grey levels, the result is the same as (for each state)
+skimage's greycomatrix(model_state, [1], [0], symmetric=False, normed=True,
+levels=2) normalized once more, as greycoprops does.
+
+Args:
+    model_states: (R x H x W) array of R binary seating distributions
+
+Returns:
+    A (2 x 2 x 1 x R) array with the GLCM of each state, like R angles of
+    skimage's GLCMs
+"""
+def get_glcm_batch(model_states):
+    model_states = np.asarray(model_states).astype(np.int64)
+    if np.any((model_states != 0) & (model_states != 1)):
+        raise ValueError("Model states must be binary.")
+    num_states = len(model_states)
+
+    # code 2 * left seat + right seat of each pair, counted for each state
+    pairs = 2 * model_states[:, :, :-1] + model_states[:, :, 1:]
+    pairs = pairs.reshape(num_states, -1) + 4 * np.arange(num_states)[:, np.newaxis]
+    counts = np.bincount(pairs.ravel(), minlength=4 * num_states)
+
+    P = np.ascontiguousarray(
+        counts.reshape(num_states, 2, 2).transpose(1, 2, 0)[:, :, np.newaxis],
+        dtype=np.float64)
+    for _ in range(2):
+        glcm_sums = np.sum(P, axis=(0, 1), keepdims=True)
+        glcm_sums[glcm_sums == 0] = 1
+        P = P / glcm_sums
+    return P
+
+
+"""
+Homogeneity of GLCMs as returned by get_glcm_batch (see skimage's greycoprops).
+Returns one value per state.
+"""
+def get_glcm_homogeneity(P):
+    I, J = np.ogrid[0:2, 0:2]
+    weights = (1. / (1. + (I - J) ** 2)).reshape((2, 2, 1, 1))
+    return np.sum(P * weights, axis=(0, 1))[0]
+
+
+"""
+Correlation of GLCMs as returned by get_glcm_batch (see skimage's greycoprops).
+Returns one value per state.
+"""
+def get_glcm_correlation(P):
+    I = np.array(range(2)).reshape((2, 1, 1, 1))
+    J = np.array(range(2)).reshape((1, 2, 1, 1))
+    diff_i = I - np.sum(I * P, axis=(0, 1))
+    diff_j = J - np.sum(J * P, axis=(0, 1))
+
+    std_i = np.sqrt(np.sum(P * (diff_i) ** 2, axis=(0, 1)))
+    std_j = np.sqrt(np.sum(P * (diff_j) ** 2, axis=(0, 1)))
+    cov = np.sum(P * (diff_i * diff_j), axis=(0, 1))
+
+    # the correlation is 1 if one of the standard deviations is (near) zero
+    results = np.ones(cov.shape)
+    mask = (std_i >= 1e-15) & (std_j >= 1e-15)
+    results[mask] = cov[mask] / (std_i[mask] * std_j[mask])
+    return results[0]
+
+
 """
 Insert aisles (represented by the given 'value') into the model_state.
 """
@@ -167,10 +327,24 @@ Returns:
     The MSE between the two lists.
 """
 def calculate_mse(list1, list2):
-    mse = 0
-    for x, y in zip(list1, list2):
-        mse += (x - y)**2
-    return mse / min(len(list1), len(list2))
+    length = min(len(list1), len(list2))
+    return get_mse_rows(np.asarray(list1, dtype=float)[np.newaxis, :length],
+                        np.asarray(list2, dtype=float)[:length])[0]
+
+
+"""
+Returns the Mean Square Error between each row of 'profiles' and 'target'. The
+squared errors are summed up one after another, so that calculate_mse,
+compare_batch and get_profile_distances give exactly the same values.
+Args:
+    profiles: (R x L) array
+    target: array of length L (or (R x L) array)
+Returns:
+    An array of length R with the MSE of each row.
+"""
+def get_mse_rows(profiles, target):
+    errors = profiles - target
+    return np.cumsum(errors * errors, axis=1)[:, -1] / profiles.shape[1]
 
 
 """
@@ -199,8 +373,6 @@ def generate_profile(models, method='lbp'):
     # setup profile depending on method type
     if method == 'lbp':
         profile = np.zeros(256)
-        f = count_lbp
-        args = []
     elif method == 'cluster':
         profile = np.zeros(reduced_models[0].shape[1]+1)
         f = count_clusters
@@ -211,11 +383,15 @@ def generate_profile(models, method='lbp'):
         args = []
 
     # build profile
-    for rm in reduced_models:
-        if method == 'cluster':
-            profile += f(rm, args)
-        else:
-            profile += f(rm)
+    if method == 'lbp':
+        # the LBP counts of all models at once
+        profile += count_lbp_batch(reduced_models).sum(axis=0)
+    else:
+        for rm in reduced_models:
+            if method == 'cluster':
+                profile += f(rm, args)
+            else:
+                profile += f(rm)
 
     return profile / len(models)
 
@@ -227,38 +403,182 @@ Args:
     method: {'homogeneity', 'correlation', 'rl_nonuniformity', 'rl_long_run_emphasis'} The method to use.
             'homogeneity' and 'correlation' are features derived from the grey-level co-occurrence matrix (GLCM).
             'rl_nonuniformity' and 'rl_long_run_emphasis' are features derived from the vector of run-lengths.
+    aisles: A list of vertical aisles, used for the run-length features.
+    run_lengths: optional RunLengths of the model state, to derive several
+            run-length features from the same encoding.
 
 Returns:
     The float value of the respective feature
 
 """
-def get_characteristic_value(model_state, method='homogeneity', aisles=[0]):
+def get_characteristic_value(model_state, method='homogeneity', aisles=[0],
+                             run_lengths=None):
 
     if method == 'homogeneity':
         # grey-level co-occurrence matrix for horizontal seat pairs with distance = 1
-        glcm = greycomatrix(model_state, [1], [0], symmetric=False, normed=True, levels=2)
-        return greycoprops(glcm, 'homogeneity')[0,0]
+        glcm = get_glcm_batch(np.asarray(model_state)[np.newaxis])
+        return get_glcm_homogeneity(glcm)[0]
 
     elif method == 'correlation':
         # grey-level co-occurrence matrix for horizontal seat pairs with distance = 1
-        glcm = greycomatrix(model_state, [1], [0], symmetric=False, normed=True, levels=2)
-        return greycoprops(glcm, 'correlation')[0,0]
+        glcm = get_glcm_batch(np.asarray(model_state)[np.newaxis])
+        return get_glcm_correlation(glcm)[0]
 
     elif method == 'rl_nonuniformity':
-        run_lengths = count_clusters(model_state, aisles)
-        num_runs = sum(run_lengths)
-        return sum([rl**2 for rl in run_lengths])/num_runs
+        if run_lengths is None:
+            run_lengths = RunLengths(model_state, aisles)
+        return run_lengths.nonuniformity()
 
     elif method == 'rl_long_run_emphasis':
-        run_lengths = count_clusters(model_state, aisles)
-        num_runs = sum(run_lengths)
-        return sum([rl * (j**2) for j, rl in enumerate(run_lengths)])/num_runs
+        if run_lengths is None:
+            run_lengths = RunLengths(model_state, aisles)
+        return run_lengths.long_run_emphasis()
 
     else:
         raise ValueError("No valid method name.")
 
 
 
+"""
+Binary and happiness states of a stack of final models, together with the
+intermediate results that several measures share (the GLCMs and run-lengths).
+Each of them is extracted or computed only once, when it is used first.
+
+Args:
+    models: list of final models (or FinalModelState instances)
+    aisles: A list of vertical aisles, used for the run-lengths.
+"""
+class ModelStates():
+
+    def __init__(self, models, aisles=[0]):
+        self.models = models
+        self.aisles = aisles
+        self._binary = None
+        self._happiness = None
+        self._glcm = None
+        self._run_lengths = None
+
+    # (R x H x W) array of the binary model states
+    def get_binary(self):
+        if self._binary is None:
+            self._binary = np.array([m.get_binary_model_state() for m in self.models])
+        return self._binary
+
+    # (R x H x W) array of the happiness model states
+    def get_happiness(self):
+        if self._happiness is None:
+            self._happiness = np.array([m.get_happiness_model_state() for m in self.models])
+        return self._happiness
+
+    # GLCMs of the binary model states (see get_glcm_batch)
+    def get_glcm(self):
+        if self._glcm is None:
+            self._glcm = get_glcm_batch(self.get_binary())
+        return self._glcm
+
+    # RunLengths of the binary model states
+    def get_run_lengths(self):
+        if self._run_lengths is None:
+            self._run_lengths = RunLengths(self.get_binary(), self.aisles)
+        return self._run_lengths
+
+
+"""
+Total happiness of each state: the happiness matrix is summed up row by row and
+the resulting row is summed up seat by seat (as sum(sum(happiness))).
+"""
+def get_total_happiness(states):
+    return np.cumsum(states.get_happiness().sum(axis=1), axis=1)[:, -1]
+
+
+"""
+The measures computed by evaluate, by name. Each measure is a function of a
+ModelStates instance that returns one value per state.
+"""
+MEASURES = collections.OrderedDict([
+    ("happiness", get_total_happiness),
+    ("homogeneity", lambda states: get_glcm_homogeneity(states.get_glcm())),
+    ("correlation", lambda states: get_glcm_correlation(states.get_glcm())),
+    ("rl_nonuniformity", lambda states: states.get_run_lengths().nonuniformity()),
+    ("rl_long_run_emphasis", lambda states: states.get_run_lengths().long_run_emphasis()),
+])
+
+
+"""
+Compute several measures of final models in one pass. The binary and happiness
+states of each model are extracted once and shared by all measures.
+
+Args:
+    models: list of final models (or FinalModelState instances)
+    measures: dict of measure name to measure function (see MEASURES)
+    aisles: A list of vertical aisles, used for the run-length features.
+
+Returns:
+    A structured array with one record per model and one float field per
+    measure, e.g. evaluate(models)["homogeneity"][0]
+"""
+def evaluate(models, measures=MEASURES, aisles=[0]):
+    states = ModelStates(models, aisles)
+    records = np.zeros(len(models), dtype=[(name, float) for name in measures])
+    if len(models) > 0:
+        for name, measure in measures.items():
+            records[name] = measure(states)
+    return records
+
+
+"""
+Computes the profiles of a stack of seating distributions with the given method.
+
+Args:
+    model_states: (R x H x W) array of R binary seating distributions
+    method: {'lbp', 'cluster', 'entropy'} The method to be used to compute the profiles
+    aisles: If using the 'cluster' method, the vertical aisles as a list.
+
+Returns:
+    A (R x profile length) array with the profile of each seating distribution
+"""
+def get_profile_batch(model_states, method='lbp', aisles=[0]):
+    if method == 'lbp':
+        return count_lbp_batch(model_states)
+    elif method == 'cluster':
+        return RunLengths(model_states, aisles).counts
+    elif method == 'entropy':
+        return get_entropy_batch(model_states)
+    else:
+        raise ValueError("Method must be 'lbp', 'cluster', or 'entropy'.")
+
+
+"""
+Returns the profile of a target seating distribution. Profiles are computed
+only once for each target (identified by the hash of its content), method and
+aisles and reused afterwards. Used by compare_batch, for the targets of the
+parameter estimation, not for one-off comparisons.
+
+Args:
+    target_state: Seating distribution as a binary matrix of seats
+    method: {'lbp', 'cluster', 'entropy'} The method to be used to compute the profile
+    aisles: If using the 'cluster' method, the vertical aisles as a list.
+
+Returns:
+    The profile as read-only array
+"""
+def get_target_profile(target_state, method='lbp', aisles=[0]):
+    target_state = np.ascontiguousarray(target_state)
+    key = (hashlib.sha1(target_state.tobytes()).hexdigest(), target_state.shape,
+           target_state.dtype.str, method, tuple(aisles))
+
+    if key in _target_profiles:
+        _target_profiles.move_to_end(key)
+        return _target_profiles[key]
+
+    profile = get_profile_batch(target_state[np.newaxis], method, aisles)[0]
+    profile.flags.writeable = False
+    _target_profiles[key] = profile
+    if len(_target_profiles) > TARGET_PROFILE_CACHE_SIZE:
+        _target_profiles.popitem(last=False)
+    return profile
+
+
 """
 Compares two seating distributions by computing the Mean Square Error between their profiles.
 
@@ -282,42 +602,185 @@ def compare(model_state_1, model_state_2, method='lbp', aisles=[0]):
     if model_state_1.ndim != 2 or model_state_2.ndim != 2:
         raise ValueError("Models must be 2D.")
 
-    if method == 'lbp':
-        # Use the Local Binary Method
-        profile_1 = count_lbp(model_state_1)
-        profile_2 = count_lbp(model_state_2)
-        return calculate_mse(profile_1, profile_2)
+    # Use the Local Binary Method, the cluster size comparison or the entropy
+    # comparison
+    profile_1 = get_profile_batch(model_state_1[np.newaxis], method, aisles)[0]
+    profile_2 = get_profile_batch(model_state_2[np.newaxis], method, aisles)[0]
+    return calculate_mse(profile_1, profile_2)
 
-    elif method == 'cluster':
-        # Use the cluster size comparison
-        profile_1 = count_clusters(model_state_1, aisles)
-        profile_2 = count_clusters(model_state_2, aisles)
-        return calculate_mse(profile_1, profile_2)
 
-    elif method == 'entropy':
-        # Use the entropy comparison
-        profile_1 = get_entropy(model_state_1)
-        profile_2 = get_entropy(model_state_2)
-        return calculate_mse(profile_1, profile_2)
+"""
+Compares a stack of seating distributions to one target distribution, like
+compare for each of them but at once. The profile of the target is cached (see
+get_target_profile).
+
+Args:
+    model_states: (R x H x W) array of R binary seating distributions
+    target_state: Seating distribution as a binary matrix of seats
+    method: {'lbp', 'cluster', 'entropy'} The method to be used to compute the profiles
+    aisles: If using the 'cluster' method, you can
+        specify where the aisles are as a list. Default [0].
+
+Returns:
+    An array with the MSE between the profile of each seating distribution and
+    the target profile
+"""
+def compare_batch(model_states, target_state, method='lbp', aisles=[0]):
+    if method not in _compare_dict:
+        raise ValueError("Method must be 'lbp', 'cluster', or 'entropy'.")
+
+    model_states = np.asarray(model_states)
+    if model_states.ndim != 3 or np.ndim(target_state) != 2:
+        raise ValueError("Models must be a stack of 2D states, the target must be 2D.")
+
+    profiles = get_profile_batch(model_states, method, aisles)
+    target_profile = get_target_profile(target_state, method, aisles)
+
+    length = min(profiles.shape[1], len(target_profile))
+    return get_mse_rows(profiles[:, :length], target_profile[:length])
 
+
+
+"""
+Computes the rows 'start' to 'end' of a distance matrix, from column 'start'
+on (the distances to the previous profiles follow from symmetry).
+
+Args:
+    inputs: (L x N) array of the profiles as columns, or for the approximate
+        mode the (N x k) reduced profiles, and the profile length L
+    start, end: the rows to compute
+
+Returns:
+    A (end - start) x (N - start) array of distances
+"""
+def get_distance_rows(inputs, start, end):
+    profiles, reduced, length = inputs
+
+    if reduced is None:
+        # squared errors summed up one after another, as by get_mse_rows
+        rows, columns = profiles[:, start:end], profiles[:, start:]
+        distances = np.zeros((end - start, columns.shape[1]))
+        for l in range(length):
+            errors = rows[l][:, np.newaxis] - columns[l][np.newaxis, :]
+            distances += errors * errors
     else:
-        return None
+        # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b
+        rows, columns = reduced[start:end], reduced[start:]
+        distances = ((rows**2).sum(axis=1)[:, np.newaxis]
+                     + (columns**2).sum(axis=1)[np.newaxis, :]
+                     - 2 * rows @ columns.T)
+        np.maximum(distances, 0, out=distances)
+
+    return distances / length
+
+
+"""
+Initialize a worker process computing distances with the profiles (see
+get_distance_rows).
+"""
+def init_distance_worker(inputs):
+    global _distance_inputs
+    _distance_inputs = inputs
+
+
+"""
+Returns (start, end, distances) for a task (start, end) of get_profile_distances.
+"""
+def distance_worker(task):
+    start, end = task
+    return start, end, get_distance_rows(_distance_inputs, start, end)
+
+
+"""
+Computes the matrix of pairwise distances between profiles (e.g. as returned
+by get_profile_batch), where the distance of two profiles is their MSE as
+computed by compare. The matrix is computed in chunks of rows, so that the
+memory used besides the result is bounded, and the chunks can be computed by
+several processes.
+
+Args:
+    profiles: (N x L) array with one profile per row
+    processes: number of worker processes computing the chunks
+    num_components: if given, the distances are approximated after projecting
+        the profiles onto their 'num_components' principal components, which
+        is much faster for large N (exact up to rounding if num_components is
+        at least the rank of the profiles)
+    max_memory: bound on the memory in bytes used for a chunk (besides the result)
+    out: optional (N x N) array that the distances are written to, e.g. a
+        np.memmap for very large N
+
+Returns:
+    The (N x N) distance matrix
+"""
+def get_profile_distances(profiles, processes=1, num_components=None,
+                          max_memory=2**27, out=None):
+    profiles = np.asarray(profiles, dtype=float)
+    num_profiles, length = profiles.shape
+
+    if num_components is None:
+        inputs = (np.ascontiguousarray(profiles.T), None, length)
+    else:
+        centered = profiles - profiles.mean(axis=0)
+        _, _, components = np.linalg.svd(centered, full_matrices=False)
+        inputs = (None, centered @ components[:num_components].T, length)
+
+    # about three arrays of the size of a chunk are used at once
+    chunk_size = max(1, max_memory // (3 * 8 * max(num_profiles, 1)))
+    tasks = [(start, min(start + chunk_size, num_profiles))
+             for start in range(0, num_profiles, chunk_size)]
+
+    if out is None:
+        out = np.empty((num_profiles, num_profiles))
+
+    if processes > 1:
+        with multiprocessing.Pool(processes, initializer=init_distance_worker,
+                                  initargs=(inputs,)) as pool:
+            for start, end, distances in pool.imap_unordered(distance_worker, tasks):
+                out[start:end, start:] = distances
+    else:
+        for start, end in tasks:
+            out[start:end, start:] = get_distance_rows(inputs, start, end)
+
+    # the distance matrix is symmetric
+    for start, end in tasks:
+        out[start:end, :start] = out[:start, start:end].T
+
+    return out
+
+
+"""
+Computes the matrix of pairwise distances between seating distributions, as
+computed by compare for each pair (see get_profile_distances).
+
+Args:
+    model_states: (N x H x W) array of N binary seating distributions
+    method: {'lbp', 'cluster', 'entropy'} The method to be used to compute the profiles
+    aisles: If using the 'cluster' method, the vertical aisles as a list.
+    kwargs: further arguments passed to get_profile_distances
+
+Returns:
+    The (N x N) distance matrix
+"""
+def get_distance_matrix(model_states, method='lbp', aisles=[0], **kwargs):
+    profiles = get_profile_batch(model_states, method, aisles)
+    return get_profile_distances(profiles, **kwargs)
 
 
 if __name__ == "__main__":
     class_size = 100
-    models = [init_default_model([0,0,0,0], class_size), init_default_model([1,0,0,1], class_size), init_default_model([0,0,1,0], class_size)]
-    for i in range(100):
-        for m in models:
-            m.step()
+    models = [run_default_models(coefs, class_size, [0], 100)[0]
+              for coefs in [[0,0,0,0], [1,0,0,1], [0,0,1,0]]]
     model_states = [m.get_binary_model_state() for m in models]
     aisles = models[0].classroom.aisles_x
+    measures = ['homogeneity', 'correlation', 'rl_nonuniformity', 'rl_long_run_emphasis']
+    records = evaluate(models, collections.OrderedDict(
+        (method, MEASURES[method]) for method in measures), aisles)
 
-    for m in model_states:
+    for m, record in zip(model_states, records):
         plt.figure()
         plt.imshow(m)
         title = ""
-        for method in ['homogeneity', 'correlation', 'rl_nonuniformity', 'rl_long_run_emphasis']:
-            title += " {} = {:.2f} ".format(method, get_characteristic_value(m, method, aisles))
+        for method in measures:
+            title += " {} = {:.2f} ".format(method, record[method])
         plt.title(title)
         plt.show()
@@ -9,6 +9,7 @@ from noisyopt import minimizeSPSA
 import time
 from os import path
 import json
+import multiprocessing
 import sys
 from scipy import stats, ndimage
 import matplotlib.pyplot as plt
@@ -24,48 +25,104 @@ TARGET_OUTPUTS = [
 
 RESULTS_JSON = []
 
+# Worker processes used by the objective function, created on first use and
+# reused for all following evaluations.
+POOL = None
+
+
+"""
+Return the pool of worker processes, which is created when it is requested for
+the first time. The workers keep their imports and cached model templates
+(classroom design and input sequences) for all following evaluations. The
+static model inputs are shared with the workers (see run_model.share_default_inputs).
+"""
+def get_pool(processes):
+    global POOL
+    if POOL is None:
+        shared_inputs = run_model.share_default_inputs(
+            [int(np.sum(target_output)) for target_output in TARGET_OUTPUTS])
+        try:
+            POOL = multiprocessing.Pool(processes, initializer=run_model.attach_shared_inputs,
+                                        initargs=(shared_inputs,))
+        except:
+            run_model.release_shared_inputs()
+            raise
+    return POOL
+
+
+"""
+Stop the pool of worker processes (if any) and free the shared model inputs.
+Tasks that are still running (e.g. after an interrupt) are not waited for.
+"""
+def close_pool():
+    global POOL
+    if POOL is not None:
+        POOL.terminate()
+        POOL.join()
+        POOL = None
+        run_model.release_shared_inputs()
+
+
+"""
+Simulate the seating process of one dataset for the given seeds and compare
+the output patterns to the target output of that dataset.
+
+Args:
+    task: tuple of (coefs, dataset index, seeds, method)
+
+Returns:
+    errors: list containing the error of each simulation, in the order of the seeds
+"""
+def objective_fill(task):
+    coefs, i, seeds, method = task
+    target_output = TARGET_OUTPUTS[i]
+    class_size = int(np.sum(target_output))
+
+    # simulate the seeds at once (unless their results are cached)
+    final_models = run_model.run_default_models(coefs, class_size, seeds, class_size)
+
+    # compute the error between model output and target output (whose profile is only computed once)
+    aisles_x = final_models[0].classroom.aisles_x
+    model_outputs = np.array([m.get_binary_model_state() for m in final_models])
+    return list(model_comparison.compare_batch(model_outputs, target_output, method=method, aisles=aisles_x))
+
 
 """
 Compute the value of the objective function for parameter estimation.
 Several seating processes with different random seeds are simulated and the output patterns are compared to the desired output.
+With more than one process the simulations are split up into tasks for a persistent pool of workers (see get_pool), the errors are the same as for a single process.
 
 Args:
     coefs: coefficients for the utility function
-    class_size: total number of students to be included into the social network
-    num_iterations: number of students that enter the classroom
-    target_output: binary matrix representing the desired seating distribution
+    num_repetitions: number of simulations with different seeds per dataset
     method: {'lbp', 'cluster', 'entropy'} The method to be used to compute the profiles of the seating distributions
+    processes: number of worker processes
 
 Returns:
     mean_error: mean MSE between model output profiles and target output profiles
 """
-def objective_function(coefs, num_repetitions, method):
+def objective_function(coefs, num_repetitions, method, processes=1):
 
     # assure that the coefficients sum up to one
     coefs = [(c/sum(coefs) if sum(coefs) > 0 else 0) for c in coefs]
     print("###########################################################################")
     print("run the model with coefficients [{:.4f} {:.4f} {:.4f} {:.4f}]".format(coefs[0],coefs[1],coefs[2],coefs[3]))
 
-    # run the model several times to handle stochasticity
-    errors = []
+    # run multiple simulations with different seeds for each dataset, the
+    # seeds are split up such that there are enough tasks for all processes
+    chunks_per_dataset = min(-(-processes // len(DATA)), num_repetitions)
+    tasks = []
     for i in range(len(DATA)):
         print("compare to the following dataset: {}".format(DATA[i]))
-        # get target seating pattern from collected data
-        #target_output = np.minimum(form_answers.get_seats(form_answers.load(DATA[i]), "seatlocation"),1)
-        target_output = TARGET_OUTPUTS[i]
-        class_size = int(np.sum(target_output))
-
-        for seed in range(num_repetitions):
-            # run multiple simulations for each dataset
-            print("repetition {}".format(seed + 1))
-            model = run_model.init_default_model(coefs, class_size, seed)
-            for n in range(class_size):
-                model.step()
-            model_output = model.get_binary_model_state()
-
-            # compute the error between model output and target output
-            aisles_x = model.classroom.aisles_x
-            errors.append(model_comparison.compare(model_output, target_output, method=method, aisles=aisles_x))
+        for seeds in np.array_split(np.arange(num_repetitions), chunks_per_dataset):
+            tasks.append((coefs, i, seeds.tolist(), method))
+
+    # run the model several times to handle stochasticity
+    if processes > 1:
+        task_errors = get_pool(processes).map(objective_fill, tasks, chunksize=1)
+    else:
+        task_errors = map(objective_fill, tasks)
+    errors = [error for errors in task_errors for error in errors]
 
     # compute the error averaged over the set of runs
     mean_error = np.mean(errors)
@@ -120,9 +177,10 @@ if __name__ == "__main__":
     """
     Run the parameter estimation.
 
-    Usage: python3 parameter_estimation.py run method
+    Usage: python3 parameter_estimation.py run method [--processes=N]
 
     where 'method' has to be one of {'entropy', 'lbp', 'cluster'}
+    and N is the number of worker processes running the simulations (default 1).
     """
     if sys.argv[1] == "run":
         method = sys.argv[2]
@@ -131,14 +189,22 @@ if __name__ == "__main__":
         num_repetitions = 10 # number of runs with different random seeds per parameter combination and per dataset
         bounds = [[0.0, 1.0], [0.0, 1.0], [0.0, 1.0], [0.0, 1.0]] # bounds for the parameters to be estimated
         x0 = np.array([0.25, 0.25, 0.25, 0.25]) # initial guess for parameters
+        processes = 1 # number of worker processes
+        for arg in sys.argv:
+            if arg.startswith("--processes="):
+                processes = int(arg.split("=")[1])
 
 
         # simultaneous perturbation stochastic approximation algorithm
-        result = minimizeSPSA(objective_function, x0,
-                args=(num_repetitions, method),
-                bounds=bounds, niter=200, paired=False)
-
-        save_json(method)
+        # (the workers are stopped and the evaluations done so far are saved,
+        # also if the optimization is interrupted)
+        try:
+            result = minimizeSPSA(objective_function, x0,
+                    args=(num_repetitions, method, processes),
+                    bounds=bounds, niter=200, paired=False)
+        finally:
+            close_pool()
+            save_json(method)
 
         print(result)
 
@@ -198,9 +264,7 @@ if __name__ == "__main__":
                 target_output = TARGET_OUTPUTS[i]
                 class_size = int(np.sum(target_output))
                 # run model
-                model = run_model.init_default_model(final_coefs, class_size, seed=123)
-                for n in range(class_size):
-                    model.step()
+                model = run_model.run_default_models(final_coefs, class_size, [123], class_size)[0]
                 model_output = model.get_binary_model_state()
                 aisles_x = model.classroom.aisles_x
 
@@ -1,7 +1,14 @@
 import sys
+import functools
+import hashlib
+import inspect
+import json
+import os
+from multiprocessing import shared_memory
 from os import path
 import pickle
 from model import *
+from social import network
 from data_processing import process_form
 
 MODEL_DATA_PATH = "animation_data"
@@ -18,6 +25,17 @@ DEFAULT_SOC_SEQ = "_sociability_sequence.pkl"
 DEFAULT_POS_UTIL = "pos_utilities.pkl"
 DEFAULT_POS_UTIL_BINS = "pos_utility_bins.pkl"
 
+# Final model states of default models are cached on disk (see ResultCache).
+# The least recently used results are removed once the cache exceeds its size.
+RESULT_CACHE_PATH = path.join("model_output", "result_cache")
+RESULT_CACHE_SIZE = 256 * 2**20  # bytes, 0 disables the cache
+
+# Static model inputs in shared memory (see share_default_inputs), as read-only
+# arrays by name. The default inputs are taken from here if available.
+SHARED_INPUTS = {}
+# Shared memory blocks of this process, as (block, created by this process)
+SHARED_MEMORY = []
+
 """
 This module provides methods to run simulations of the ClassroomModel
 If used as a script: generates the model data that is needed for animation
@@ -29,6 +47,9 @@ Usage:
 
 def get_default_pos_utilities():
 
+    if "pos_utilities" in SHARED_INPUTS:
+        return SHARED_INPUTS["pos_utilities"]
+
     file_path = path.join(MODEL_INPUT_PATH, DEFAULT_POS_UTIL)
     if path.isfile(file_path):
         with open(file_path, 'rb') as f:
@@ -58,6 +79,9 @@ def get_default_pos_utility_bins():
 
 def get_block_pos_utilities():
 
+    if "block_pos_utilities" in SHARED_INPUTS:
+        return SHARED_INPUTS["block_pos_utilities"]
+
     # Assumes classroom to be default shape
     seating_bins = np.ones((14, 22))
 
@@ -77,6 +101,10 @@ def get_block_pos_utilities():
 
 def get_default_sociability_sequence(class_size):
 
+    name = "sociability_sequence_{}".format(class_size)
+    if name in SHARED_INPUTS:
+        return SHARED_INPUTS[name]
+
     file_path = path.join(
         MODEL_INPUT_PATH, "size_" + str(class_size) + DEFAULT_SOC_SEQ)
     if path.isfile(file_path):
@@ -114,6 +142,10 @@ def generate_sociability_sequence(class_size, distribution, seed=0):
 
 def get_default_degree_sequence(class_size):
 
+    name = "degree_sequence_{}".format(class_size)
+    if name in SHARED_INPUTS:
+        return SHARED_INPUTS[name]
+
     file_path = path.join(
         MODEL_INPUT_PATH, "size_" + str(class_size) + DEFAULT_DEG_SEQ)
     if path.isfile(file_path):
@@ -130,6 +162,118 @@ def get_default_degree_sequence(class_size):
         return degree_sequence
 
 
+"""
+Place the static inputs of the default models (positional utilities and the
+degree and sociability sequences for the given class sizes) in one block of
+shared memory, which worker processes attach to with attach_shared_inputs.
+The inputs are loaded (or generated) only once, by the calling process.
+Call release_shared_inputs once the workers are done.
+
+Args:
+    class_sizes: class sizes for which the sequences are needed
+
+Returns:
+    shared_inputs: (name of the shared memory block, {input name: (offset,
+    shape)}), small enough to be passed to each worker
+"""
+def share_default_inputs(class_sizes):
+
+    inputs = {"pos_utilities": get_default_pos_utilities(),
+              "block_pos_utilities": get_block_pos_utilities()}
+    for class_size in sorted(set(class_sizes)):
+        inputs["degree_sequence_{}".format(class_size)] = \
+            get_default_degree_sequence(class_size)
+        inputs["sociability_sequence_{}".format(class_size)] = \
+            get_default_sociability_sequence(class_size)
+    inputs = {name: np.asarray(value, dtype=float)
+              for name, value in inputs.items()}
+
+    # Copy all inputs into one block, one after another
+    layout = {}
+    size = 0
+    for name, value in inputs.items():
+        layout[name] = (size, value.shape)
+        size += value.nbytes
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    SHARED_MEMORY.append((block, True))
+    for name, value in inputs.items():
+        offset, shape = layout[name]
+        np.ndarray(shape, dtype=float, buffer=block.buf, offset=offset)[:] = value
+
+    shared_inputs = (block.name, layout)
+    attach_shared_inputs(shared_inputs)
+    return shared_inputs
+
+
+"""
+Use the static inputs placed in shared memory by share_default_inputs (e.g. as
+initializer of a worker process). The default inputs are then read-only views
+of the shared memory instead of copies.
+
+Args:
+    shared_inputs: as returned by share_default_inputs
+"""
+def attach_shared_inputs(shared_inputs):
+
+    name, layout = shared_inputs
+    for block, _ in SHARED_MEMORY:
+        if block.name == name:
+            break
+    else:
+        block = shared_memory.SharedMemory(name=name)
+        SHARED_MEMORY.append((block, False))
+
+    for input_name, (offset, shape) in layout.items():
+        view = np.ndarray(shape, dtype=float, buffer=block.buf, offset=offset)
+        view.flags.writeable = False
+        SHARED_INPUTS[input_name] = view
+
+
+"""
+Stop using shared inputs and free the shared memory created by this process.
+"""
+def release_shared_inputs():
+
+    SHARED_INPUTS.clear()
+    # models set up from the shared inputs refer to them
+    get_default_model_template.cache_clear()
+    while SHARED_MEMORY:
+        block, created = SHARED_MEMORY.pop()
+        try:
+            block.close()
+        except BufferError:
+            # still referred to by a model, the memory is freed once the
+            # process ends
+            pass
+        if created:
+            block.unlink()
+
+
+"""
+Get the default ClassroomDesign. It is created only once and shared by all
+default models, so that its layout index (see ClassroomDesign.get_layout_index)
+is computed only once.
+
+Returns:
+    classroom: ClassroomDesign instance
+"""
+@functools.lru_cache(maxsize=None)
+def get_default_classroom():
+
+    # Using the default classroom size of [6,14,0] blocks and 14 rows
+
+    """ run the following to use the entire range of pos_utilities """
+    #classroom = ClassroomDesign(pos_utilities=get_default_pos_utilities())
+
+    """ run the following to use bins of pos_utilities """
+    # classroom = ClassroomDesign(pos_utilities=get_default_pos_utility_bins())
+
+    """ run the following to use custom bins of pos_utilities """
+    classroom = ClassroomDesign(pos_utilities=get_block_pos_utilities())
+
+    return classroom
+
+
 """
 Initialize the default ClassroomModel (based on collected data)
 
@@ -147,61 +291,383 @@ Args:
                         social aversion. Otherwise, the sociability sequence
                         derived from the data is used, where sociability values
                         only range from 0 to 1.
+    array_engine: if True, the array-backed ArrayClassroomModel is used instead
+                        of the Seat and Student based ClassroomModel. Both
+                        produce the same seating decisions.
+    record_states: which model states are stored during the simulation. One
+                        of "full", "final", "none" or an integer N (every N
+                        steps). Use "none" if only the final seating pattern is
+                        of interest.
+    choice_policy: probabilistic seat choice used if deterministic_choice is
+                        False, e.g. SoftmaxChoice(temperature=0.1). Defaults
+                        to TopFractionChoice(seat_fraction).
+    moving_prob: probability per step that a seated student reconsiders its
+                        seat once its surroundings changed (0 disables the
+                        relocation phase).
+    moving_threshold: minimal utility gain for which a student changes its
+                        seat.
 
 Returns:
     model: the created model instance
 """
 def init_default_model(coefs, class_size, seed=0, seat_fraction=0.5,
                        deterministic_choice=True, social_aversion=False,
-                       scale=True):
+                       scale=True, array_engine=False, record_states="full",
+                       choice_policy=None, moving_prob=0,
+                       moving_threshold=0.1):
 
-    # Using the default classroom size of [6,14,0] blocks and 14 rows
-
-    """ run the following to use the entire range of pos_utilities """
-    #classroom = ClassroomDesign(pos_utilities=get_default_pos_utilities())
+    options = dict(seat_fraction=seat_fraction,
+                   deterministic_choice=deterministic_choice, scale=scale,
+                   record_states=record_states, choice_policy=choice_policy,
+                   moving_prob=moving_prob, moving_threshold=moving_threshold)
 
-    """ run the following to use bins of pos_utilities """
-    # classroom = ClassroomDesign(pos_utilities=get_default_pos_utility_bins())
+    if not social_aversion:
+        # Only the random parts of the model depend on the seed, so the model
+        # is cloned from a template that is set up once per configuration
+        template = get_default_model_template(
+            tuple(coefs), isinstance(coefs, np.ndarray), class_size,
+            array_engine, **options)
+        return template.clone(seed)
 
-    """ run the following to use custom bins of pos_utilities """
-    classroom = ClassroomDesign(pos_utilities=get_block_pos_utilities())
+    classroom = get_default_classroom()
 
     # The degree sequence for the social network is sampled from the observed
     # distribution of number of friends
     degree_sequence = get_default_degree_sequence(class_size)
 
-    if social_aversion:
-        # The sociability sequence is sampled randomly from a distribution, including negative values
-        """ use the following line to sample from a gaussian distribution"""
-        #sociability_sequence = generate_sociability_sequence(class_size, "gaussian", seed)
+    # The sociability sequence is sampled randomly from a distribution, including negative values
+    """ use the following line to sample from a gaussian distribution"""
+    #sociability_sequence = generate_sociability_sequence(class_size, "gaussian", seed)
 
-        """ use the following line to sample from a cauchy distribution"""
-        #sociability_sequence = generate_sociability_sequence(class_size, "cauchy", seed)
+    """ use the following line to sample from a cauchy distribution"""
+    #sociability_sequence = generate_sociability_sequence(class_size, "cauchy", seed)
 
-        """ use the following line to sample from a uniform distribution in the interval [-1,1]"""
-        #sociability_sequence = generate_sociability_sequence(class_size, "uniform_aversion", seed)
+    """ use the following line to sample from a uniform distribution in the interval [-1,1]"""
+    #sociability_sequence = generate_sociability_sequence(class_size, "uniform_aversion", seed)
 
-        """ use the following line to sample from a uniform distribution in the interval [0,1]"""
-        sociability_sequence = generate_sociability_sequence(class_size, "uniform_affection", seed)
+    """ use the following line to sample from a uniform distribution in the interval [0,1]"""
+    sociability_sequence = generate_sociability_sequence(class_size, "uniform_affection", seed)
 
-        # scale to range [-1,1]
-        sociability_sequence = (((sociability_sequence - np.min(sociability_sequence)) * 2) / (np.max(sociability_sequence - np.min(sociability_sequence)))) - 1
-
-    else:
-        # The sociability sequence is based on the distribution observed in the collected data
-        sociability_sequence = get_default_sociability_sequence(class_size)
+    # scale to range [-1,1]
+    sociability_sequence = (((sociability_sequence - np.min(sociability_sequence)) * 2) / (np.max(sociability_sequence - np.min(sociability_sequence)))) - 1
 
     # create the model
-    model = ClassroomModel(classroom, coefs,
-                           sociability_sequence=sociability_sequence,
-                           degree_sequence=degree_sequence, seed=seed,
-                           seat_fraction=seat_fraction,
-                           deterministic_choice=deterministic_choice,
-                           scale=scale)
+    model_class = ArrayClassroomModel if array_engine else ClassroomModel
+    model = model_class(classroom, coefs,
+                        sociability_sequence=sociability_sequence,
+                        degree_sequence=degree_sequence, seed=seed, **options)
 
     return model
 
 
+"""
+Get a template of the default model (based on collected data) for the given
+configuration, from which fresh models are created with model.clone(seed).
+The classroom design, the degree and sociability sequences and the model
+configuration are only set up once. The parts that depend on the seed, such as
+the social network, are only created by clone. The most recently used
+templates are kept.
+
+Args:
+    coefs: tuple of coefficients for the utility function
+    array_coefs: if True, the coefficients are passed to the model as array
+    class_size: number of students in the class, forming the social network
+    array_engine: if True, the ArrayClassroomModel is used
+    options: further model arguments (see init_default_model)
+
+Returns:
+    template: model template (see ClassroomModel.template)
+"""
+@functools.lru_cache(maxsize=16)
+def get_default_model_template(coefs, array_coefs, class_size,
+                               array_engine=False, **options):
+
+    coefs = np.array(coefs) if array_coefs else list(coefs)
+    model_class = ArrayClassroomModel if array_engine else ClassroomModel
+    template = model_class.template(
+        get_default_classroom(), coefs,
+        sociability_sequence=get_default_sociability_sequence(class_size),
+        degree_sequence=get_default_degree_sequence(class_size), **options)
+
+    return template
+
+
+"""
+Initialize a batch of default models that only differ in their random seed.
+All replicates are simulated simultaneously by the BatchClassroomModel.
+
+Args:
+    coefs: coefficients for the utility function
+    class_size: number of students in the class, forming the social network
+    seeds: list of seeds, one for each replicate
+    kwargs: further arguments passed to init_default_model
+
+Returns:
+    batch: the created BatchClassroomModel instance
+"""
+def init_default_batch_model(coefs, class_size, seeds, **kwargs):
+
+    kwargs.setdefault("record_states", "none")
+    models = [init_default_model(coefs, class_size, seed, array_engine=True,
+                                 **kwargs) for seed in seeds]
+
+    return BatchClassroomModel(models)
+
+
+class FinalModelState():
+
+    """Seating distribution and happiness of a model in its final state, as
+    stored in the ResultCache. Provides the state methods of the models, so
+    that it can be analysed like a final model.
+
+    Args:
+        classroom: ClassroomDesign of the model
+        binary_state: binary matrix (see ClassroomModel.get_binary_model_state)
+        happiness_state: happiness matrix (see
+            ClassroomModel.get_happiness_model_state)
+
+    """
+    def __init__(self, classroom, binary_state, happiness_state):
+        self.classroom = classroom
+        self.binary_state = binary_state
+        self.happiness_state = happiness_state
+
+    def get_binary_model_state(self):
+        """Return the final seating distribution (aisles stripped)."""
+        return self.binary_state.copy()
+
+    def get_happiness_model_state(self):
+        """Return the happiness of each student at each seat in the final
+        state (aisles stripped)."""
+        return self.happiness_state.copy()
+
+
+class ResultCache():
+
+    """Persistent cache of final model states on disk. Each result is stored
+    in its own file, named after the hash of everything the simulation depends
+    on (see get_result_key). Whenever the files exceed 'max_size' bytes, the
+    least recently used results are removed.
+
+    Args:
+        cache_path: directory of the result files
+        max_size: maximal total size of the result files in bytes
+
+    """
+    def __init__(self, cache_path=RESULT_CACHE_PATH,
+                 max_size=RESULT_CACHE_SIZE):
+        self.cache_path = cache_path
+        self.max_size = max_size
+        os.makedirs(cache_path, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.get_files())
+
+    def get_files(self):
+        """Return (file path, size, last use) of all result files."""
+        files = []
+        for name in os.listdir(self.cache_path):
+            file_path = path.join(self.cache_path, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                # removed by another process in the meantime
+                continue
+            files.append((file_path, stat.st_size, stat.st_mtime))
+        return files
+
+    def get(self, key):
+        """Return the (binary state, happiness state) stored for the given key,
+        or None if it is not in the cache."""
+        file_path = path.join(self.cache_path, key + ".npz")
+        try:
+            with np.load(file_path) as data:
+                states = (data["binary_state"], data["happiness_state"])
+            # mark the result as recently used
+            os.utime(file_path)
+        except (OSError, KeyError, ValueError):
+            return None
+        return states
+
+    def put(self, key, binary_state, happiness_state):
+        """Store the final states for the given key."""
+        file_path = path.join(self.cache_path, key + ".npz")
+        # write to a temporary file first, so that other processes never read
+        # a partly written result
+        tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(f, binary_state=binary_state,
+                     happiness_state=happiness_state)
+        # an existing result for the key is replaced
+        try:
+            self.size -= path.getsize(file_path)
+        except OSError:
+            pass
+        os.replace(tmp_path, file_path)
+        self.size += path.getsize(file_path)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used results until the cache is back
+        within 90% of its size."""
+        files = sorted(self.get_files(), key=lambda f: f[2])
+        self.size = sum(size for _, size, _ in files)
+        for file_path, size, _ in files:
+            if self.size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+            self.size -= size
+
+
+"""
+Get the ResultCache of this process, which is created on first use. Returns
+None if the cache is disabled (RESULT_CACHE_SIZE = 0).
+"""
+@functools.lru_cache(maxsize=None)
+def get_result_cache():
+
+    if RESULT_CACHE_SIZE <= 0:
+        return None
+    return ResultCache()
+
+
+"""
+Hash of the source code of the model, so that cached results are not used
+anymore once the model changes.
+"""
+@functools.lru_cache(maxsize=None)
+def get_code_version():
+
+    version = hashlib.sha1()
+    for module in [ClassroomModel, network]:
+        with open(inspect.getsourcefile(module), 'rb') as f:
+            version.update(f.read())
+    return version.hexdigest()
+
+
+"""
+Hash of a ClassroomDesign, covering everything that affects the simulation.
+"""
+def get_design_hash(classroom):
+
+    design = hashlib.sha1()
+    design.update(json.dumps([classroom.width, classroom.num_rows,
+                              classroom.aisles_x, classroom.aisles_y,
+                              classroom.entrances]).encode())
+    design.update(np.ascontiguousarray(classroom.pos_utilities,
+                                       dtype=float).tobytes())
+    return design.hexdigest()
+
+
+"""
+Get the key under which the final state of a default model is cached.
+
+Args:
+    coefs: coefficients for the utility function
+    class_size: number of students in the class
+    seed: for random number generation
+    num_iterations: number of steps the model is run
+    seat_fraction, deterministic_choice, scale, choice_policy, moving_prob,
+    moving_threshold: model options (see init_default_model)
+
+Returns:
+    key: hexadecimal hash
+"""
+def get_result_key(coefs, class_size, seed, num_iterations, seat_fraction=0.5,
+                   deterministic_choice=True, scale=True, choice_policy=None,
+                   moving_prob=0, moving_threshold=0.1):
+
+    # The coefficients as used by the model (see ClassroomModel.set_coefs)
+    random_seat_choice = bool(np.all(coefs == 0))
+    if scale:
+        coefs = [(c/sum(coefs) if sum(coefs) > 0 else 0) for c in coefs]
+
+    if choice_policy is not None:
+        choice_policy = [type(choice_policy).__name__,
+                         sorted(vars(choice_policy).items())]
+
+    key = [[float(c) for c in coefs], random_seat_choice, int(seed),
+           int(num_iterations), get_default_inputs_digest(int(class_size)),
+           deterministic_choice, float(seat_fraction), choice_policy,
+           float(moving_prob), float(moving_threshold)]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+
+"""
+Hash of everything a default model of the given class size is set up from:
+the class size, the classroom design, the degree and sociability sequences and
+the model code. It is computed only once per class size (see get_result_key).
+"""
+@functools.lru_cache(maxsize=None)
+def get_default_inputs_digest(class_size):
+
+    inputs = hashlib.sha1(pickle.dumps(
+        (class_size,
+         list(map(float, get_default_sociability_sequence(class_size))),
+         list(map(int, get_default_degree_sequence(class_size))))))
+    inputs.update(get_design_hash(get_default_classroom()).encode())
+    inputs.update(get_code_version().encode())
+    return inputs.hexdigest()
+
+
+"""
+Run default models (see init_default_model) with the given seeds and return
+their final states. Results are taken from the ResultCache if possible, the
+remaining seeds are simulated simultaneously by a BatchClassroomModel and
+added to the cache.
+
+Args:
+    coefs: coefficients for the utility function
+    class_size: number of students in the class, forming the social network
+    seeds: list of seeds, one for each model
+    num_iterations: number of steps each model is run
+    use_cache: if False, all models are simulated and nothing is cached
+    kwargs: further arguments passed to init_default_model
+
+Returns:
+    final_states: list of FinalModelState instances, one for each seed
+"""
+def run_default_models(coefs, class_size, seeds, num_iterations,
+                       use_cache=True, **kwargs):
+
+    kwargs.pop("record_states", None)
+    kwargs.pop("array_engine", None)
+    cache = get_result_cache() if use_cache else None
+    if kwargs.pop("social_aversion", False):
+        # the sociability sequence is not taken from the default inputs
+        cache = None
+        kwargs["social_aversion"] = True
+
+    seeds = list(seeds)
+    final_states = [None] * len(seeds)
+    keys = [None] * len(seeds)
+    if cache is not None:
+        for i, seed in enumerate(seeds):
+            keys[i] = get_result_key(coefs, class_size, seed, num_iterations,
+                                     **kwargs)
+            states = cache.get(keys[i])
+            if states is not None:
+                final_states[i] = FinalModelState(get_default_classroom(),
+                                                  *states)
+
+    missing = [i for i in range(len(seeds)) if final_states[i] is None]
+    if missing:
+        batch = init_default_batch_model(coefs, class_size,
+                                         [seeds[i] for i in missing], **kwargs)
+        batch = final_model(batch, num_iterations)
+        for i, model in zip(missing, batch.models):
+            final_states[i] = FinalModelState(
+                model.classroom, model.get_binary_model_state(),
+                model.get_happiness_model_state())
+            if cache is not None:
+                cache.put(keys[i], final_states[i].binary_state,
+                          final_states[i].happiness_state)
+
+    return final_states
+
+
 """
 Determine relevant properties of the current model state and create an image representation
 
@@ -316,8 +782,10 @@ if __name__ == "__main__":
 
         # Use the following to simulate the model with deterministic choice of
         # the highest rated seat
+        # The model states for the animation are generated by generate_data
         models.append(init_default_model(
-            coefs, CLASS_SIZE, deterministic_choice=True, social_aversion=True))
+            coefs, CLASS_SIZE, deterministic_choice=True, social_aversion=True,
+            record_states="none"))
 
     try:
         generate_data(
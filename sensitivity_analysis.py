@@ -1,8 +1,11 @@
 import collections
 import copy as c
+import json
+import multiprocessing
 import os
 import pickle
 import sys
+import time
 
 from SALib.sample import saltelli
 from SALib.analyze import sobol
@@ -28,6 +31,10 @@ For Sobol analysis generate the data and analyze it separately:
     python3 sensitivity_analysis.py --sobol-run
     python3 sensitivity_analysis.py --sobol-analysis
 
+The OFAT and Sobol samples can be run in parallel with e.g. `--processes=8`.
+Each finished Sobol sample is appended to a result store on disk, so an interrupted Sobol
+run continues where it stopped when it is started again.
+
 NOTE: Between a run and analysis the parameters below should remain unchanged.
 """
 
@@ -44,25 +51,18 @@ SOBOL_SAMPLES = 2000  # Total Saltelli samples: `SOBOL_SAMPLES` * 12
 SOBOL_REPLICATES = 1  # Replicates per each Sobol sample.
 SOBOL_RESULTS_FILENAME = "_sobol-samples-{}-replicates-{}.pickle".format(
     SOBOL_SAMPLES, SOBOL_REPLICATES)
+SOBOL_STORE_FILENAME = "_sobol-samples-{}-replicates-{}.jsonl".format(
+    SOBOL_SAMPLES, SOBOL_REPLICATES)
 FIXED_N = True
 
 # The output measures used to analyze the final state of a model.
-# Each function takes a model (in end state) as first and only argument.
-COMPARISONS = collections.OrderedDict({
-    "happiness": lambda m: sum(sum(m.get_happiness_model_state())),
-
-    "homogeneity": lambda m: model_comparison.get_characteristic_value(
-        m.get_binary_model_state()),
-
-    "correlation": lambda m: model_comparison.get_characteristic_value(
-        m.get_binary_model_state(), method="correlation"),
-
-    "rl_nonuniformity": lambda m: model_comparison.get_characteristic_value(
-        m.get_binary_model_state(), method="rl_nonuniformity"),
-
-    "rl_long_run_emphasis": lambda m: model_comparison.get_characteristic_value(
-        m.get_binary_model_state(), method="rl_long_run_emphasis")
-})
+# Each function takes a `model_comparison.ModelStates` of final models as first
+# and only argument and returns one value per model (see
+# `model_comparison.MEASURES`), so all measures are computed in one pass.
+COMPARISONS = collections.OrderedDict(
+    (name, model_comparison.MEASURES[name]) for name in [
+        "happiness", "homogeneity", "correlation", "rl_nonuniformity",
+        "rl_long_run_emphasis"])
 
 # Iterations to run each model for.
 MAX_STUDENTS = 260
@@ -87,9 +87,12 @@ PARAMETERS = {
 # Path to where OFAT and SOBOL results are saved.
 RESULTS_PATH = "./sensitivity-analysis-data"
 
+# Worker processes for OFAT and Sobol runs, can be set with --processes=N.
+PROCESSES = 1
+
 
 def run(b1, b2, b3, b4, class_size, model_iterations, comparison_methods,
-        fixed_class_size=None, scale=True):
+        fixed_class_size=None, scale=True, seed=0):
     """
     Run the model with given class size and beta coefficients.
     Return a list containing a result for each given comparison method.
@@ -100,6 +103,7 @@ def run(b1, b2, b3, b4, class_size, model_iterations, comparison_methods,
         fixed_class_size: float, convenience way to override class_size.
         model_iterations: int, amount of iterations to run each model.
         comparison_methods: dict, of string to comparison function.
+        seed: int, seed for the random number generation of the model.
     """
     # Setup parameters.
     if fixed_class_size is not None:
@@ -107,22 +111,192 @@ def run(b1, b2, b3, b4, class_size, model_iterations, comparison_methods,
     class_size = int(class_size)
     coefficients = [b1, b2, b3, b4]
 
-    # Setup initial model and run it.
-    model = run_model.init_default_model(coefficients, class_size, scale=scale)
-    final_model = run_model.final_model(model, model_iterations)
+    # Run the model, or take its final state from the result cache.
+    final_model = run_model.run_default_models(
+        coefficients, class_size, [seed], model_iterations, scale=scale)[0]
+
+    return get_measures([final_model], comparison_methods)[0]
+
+
+def run_replicates(b1, b2, b3, b4, class_size, model_iterations,
+                   comparison_methods, seeds, fixed_class_size=None,
+                   scale=True):
+    """
+    Like `run`, but simulate one replicate for each of the given seeds at
+    once using a BatchClassroomModel (replicates in the result cache are not
+    simulated again). Return a list containing the results of `run` for each
+    seed (in the same order).
+
+    Args:
+        seeds: list of int, one seed for each replicate.
+        (see `run` for the other arguments)
+    """
+    # Setup parameters.
+    if fixed_class_size is not None:
+        class_size = fixed_class_size
+    class_size = int(class_size)
+    coefficients = [b1, b2, b3, b4]
+
+    # Run the replicates simultaneously.
+    final_models = run_model.run_default_models(
+        coefficients, class_size, seeds, model_iterations, scale=scale)
+
+    return get_measures(final_models, comparison_methods)
 
-    # Collect comparison measures and return them.
-    comparison_values = []
-    for comparison_method, comparison_f in comparison_methods.items():
-        comparison_values.append(comparison_f(final_model))
+
+def get_measures(final_models, comparison_methods):
+    """Return a list for each of the given models in its end state, containing
+    a result for each given comparison method."""
+    records = model_comparison.evaluate(final_models, comparison_methods)
+    return [replace_inf([record[name] for name in comparison_methods])
+            for record in records]
+
+
+def replace_inf(comparison_values):
+    """Replace infinite measures by 0."""
     return list(map(lambda x: 0 if np.isinf(x) else x, comparison_values))
 
 
+class ResultStore():
+    """Append-only store of per-sample results on disk, one JSON line per
+    sample, so that an interrupted run can be resumed.
+
+    The first line holds the configuration of the run. Results are only loaded
+    from a store with the same configuration. A last line that was only
+    partly written (e.g. because the process was killed) is ignored, a store
+    without a complete first line is started anew.
+
+    Args:
+        path: str, path of the store file.
+        config: dict, JSON serializable configuration of the run.
+    """
+    def __init__(self, path, config):
+        self.path = path
+        self.config = json.loads(json.dumps(config))
+        self.results = {}
+
+        stored = None
+        if os.path.isfile(path):
+            with open(path) as f:
+                content = stored = f.read()
+        else:
+            content = ""
+
+        # Drop a partly written last line so that appends start on a new line.
+        if not content.endswith("\n"):
+            content = content[:content.rfind("\n") + 1]
+
+        # A header that is missing or was only partly written (the run was
+        # stopped right at the start) is written anew.
+        lines = content.split("\n")
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or "config" not in header:
+            content = json.dumps({"config": self.config}) + "\n"
+            lines = []
+        elif header["config"] != self.config:
+            raise ValueError("The result store {} belongs to a run with a "
+                             "different configuration".format(path))
+
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self.results[entry["sample"]] = entry["measures"]
+
+        if content != stored:
+            with open(path, "w") as f:
+                f.write(content)
+
+    def append(self, sample, measures):
+        """Write the measures of the given sample to disk immediately."""
+        measures = [float(x) for x in measures]
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"sample": sample, "measures": measures}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.results[sample] = measures
+
+
+def get_sobol_sample_measures(sample_count, sample_params, sobol_replicates,
+                              fixed_class_size, model_iterations,
+                              comparison_methods):
+    """Run `sobol_replicates` replicates of the given Sobol sample and return
+    the mean of each measure. The seed of each replicate only depends on the
+    number of the sample, so results do not depend on the order (or process)
+    in which samples are run."""
+    replicate_measures = []
+    for r in range(sobol_replicates):
+        seed = sample_count * sobol_replicates + r
+        replicate_measures.append(run(*sample_params,
+                                      fixed_class_size=fixed_class_size,
+                                      model_iterations=model_iterations,
+                                      comparison_methods=comparison_methods,
+                                      seed=seed))
+    return [np.mean(x) for x in np.array(replicate_measures).T]
+
+
+# Comparison methods of a worker process, set by `init_worker`.
+_worker_comparison_methods = None
+
+
+def init_worker(comparison_names, shared_inputs):
+    """Initialize a worker process with the comparison methods of the given
+    names, looked up in `model_comparison.MEASURES` (the functions themselves
+    are often lambdas, which cannot be pickled), and the static model inputs
+    in shared memory (see `run_model.share_default_inputs`)."""
+    global _worker_comparison_methods
+    _worker_comparison_methods = collections.OrderedDict(
+        (name, model_comparison.MEASURES[name]) for name in comparison_names)
+    run_model.attach_shared_inputs(shared_inputs)
+
+
+def run_pool(worker, tasks, processes, comparison_methods, class_sizes):
+    """Run the tasks with a pool of worker processes and yield the results in
+    the order in which they are finished. The default model inputs for the
+    given class sizes are shared with the workers. The workers get the names
+    of the comparison methods, which must be measures of
+    `model_comparison.MEASURES`."""
+    for name, method in comparison_methods.items():
+        if model_comparison.MEASURES.get(name) is not method:
+            raise ValueError("Comparison method '{}' is not in "
+                             "model_comparison.MEASURES.".format(name))
+
+    shared_inputs = run_model.share_default_inputs(
+        int(class_size) for class_size in class_sizes)
+    try:
+        with multiprocessing.Pool(
+                processes, initializer=init_worker,
+                initargs=(list(comparison_methods), shared_inputs)) as pool:
+            yield from pool.imap_unordered(worker, tasks)
+    finally:
+        run_model.release_shared_inputs()
+
+
+def sobol_worker(task):
+    """Return (sample number, measures) for a task of `run_sobol_analysis`."""
+    sample_count = task[0]
+    return sample_count, get_sobol_sample_measures(
+        *task, comparison_methods=_worker_comparison_methods)
+
+
+def ofat_worker(task):
+    """Return (i, j, measures of each replicate) for a task of
+    `run_ofat_analysis`."""
+    i, j, sample_params, runs_per_sample, model_iterations = task
+    return i, j, get_ofat_sample_measures(sample_params, runs_per_sample,
+                                          model_iterations,
+                                          _worker_comparison_methods)
+
+
 def run_sobol_analysis(parameters=PARAMETERS, num_samples=SOBOL_SAMPLES,
                        model_iterations=MODEL_ITERATIONS,
                        comparison_methods=COMPARISONS,
                        sobol_replicates=SOBOL_REPLICATES,
-                       fixed_class_size=None):
+                       fixed_class_size=None, processes=1, store_path=None):
     """Run, print and save sensitivity analysis.
 
     Args:
@@ -133,6 +307,13 @@ def run_sobol_analysis(parameters=PARAMETERS, num_samples=SOBOL_SAMPLES,
         sobol_replicates: int, replicates per each sample (averaged).
         fixed_class_size: int, fix class size to given number (note that in
             this case class size must not be in the given parameters)
+        processes: int, amount of worker processes running the samples. The
+            comparison methods are passed to the workers on process creation
+            (inherited with the default "fork" start method on Linux,
+            otherwise they must be picklable).
+        store_path: str, optional path of a `ResultStore`. Measures of each
+            sample are appended as soon as the sample is finished, and samples
+            found in the store are not run again.
     """
     parameters["num_vars"] = len(parameters["names"])
     samples = saltelli.sample(parameters, num_samples)
@@ -140,30 +321,49 @@ def run_sobol_analysis(parameters=PARAMETERS, num_samples=SOBOL_SAMPLES,
         samples.shape[0], sobol_replicates,
         samples.shape[0] * sobol_replicates))
 
-    def get_sample_measures(sample):
-        """Return output measures for the given sample."""
-        return run(*sample,
-                   fixed_class_size=fixed_class_size,
-                   model_iterations=model_iterations,
-                   comparison_methods=comparison_methods)
-
-    # Calculate measures for each sample and append to this results array.
-    results = []
-    sample_count = 0
-    for sample_params in samples:
+    # Resume from the result store, if there is one.
+    if store_path is not None:
+        store = ResultStore(store_path, {
+            "names": parameters["names"], "bounds": parameters["bounds"],
+            "num_samples": num_samples, "sobol_replicates": sobol_replicates,
+            "model_iterations": model_iterations,
+            "comparison_methods": list(comparison_methods),
+            "fixed_class_size": fixed_class_size})
+        results = store.results
+        print("Resuming with {} finished samples from {}".format(
+            len(results), store_path))
+    else:
+        results = {}
 
-        # Run `sobol_replicates` replicates and take the mean of each measure.
-        replicate_measures = []
-        for _ in range(sobol_replicates):
-            replicate_measures.append(get_sample_measures(sample_params))
-        sample_measures = [np.mean(x) for x in np.array(replicate_measures).T]
+    tasks = [(sample_count, sample_params, sobol_replicates, fixed_class_size,
+              model_iterations)
+             for sample_count, sample_params in enumerate(samples)
+             if sample_count not in results]
 
+    def save(sample_count, sample_measures):
+        """Print and collect the measures of a finished sample."""
         print("\nSample: {}\nparameters: {}\nmeasures: {}\nfixed class size: {}".format(
-                sample_count, sample_params, sample_measures, fixed_class_size))
-        results.append(sample_measures)
-        sample_count += 1
+                sample_count, samples[sample_count], sample_measures,
+                fixed_class_size))
+        if store_path is not None:
+            store.append(sample_count, sample_measures)
+        else:
+            results[sample_count] = sample_measures
+
+    # Calculate measures for each sample, in this process or by the workers.
+    if processes > 1:
+        class_sizes = [fixed_class_size if fixed_class_size is not None
+                       else task[1][4] for task in tasks]
+        for sample_count, sample_measures in run_pool(
+                sobol_worker, tasks, processes, comparison_methods,
+                class_sizes):
+            save(sample_count, sample_measures)
+    else:
+        for task in tasks:
+            save(task[0], get_sobol_sample_measures(
+                *task, comparison_methods=comparison_methods))
 
-    return results
+    return [results[sample_count] for sample_count in range(len(samples))]
 
 
 def display_sobol_results(results, parameters=PARAMETERS,
@@ -228,11 +428,23 @@ def display_sobol_results(results, parameters=PARAMETERS,
             plt.show()
 
 
+def get_ofat_sample_measures(sample_params, runs_per_sample, model_iterations,
+                             comparison_methods):
+    """Return the measures of each replicate of the given OFAT sample. One run
+    for each replicate, each with its own seed. All replicates are simulated at
+    once."""
+    return run_replicates(*sample_params,
+                          model_iterations=model_iterations,
+                          comparison_methods=comparison_methods,
+                          seeds=range(runs_per_sample),
+                          scale=OFAT_SCALE_COEFS)
+
+
 def run_ofat_analysis(parameters=PARAMETERS,
                       samples_per_param=SAMPLES_PER_PARAM,
                       runs_per_sample=RUNS_PER_SAMPLE,
                       model_iterations=MODEL_ITERATIONS,
-                      comparison_methods=COMPARISONS):
+                      comparison_methods=COMPARISONS, processes=1):
     """Run OFAT for each of the given parameters ranges.
 
     Return a (samples_per_param, num_params, num_comparisons) size matrix. Thus
@@ -245,12 +457,18 @@ def run_ofat_analysis(parameters=PARAMETERS,
 
         [[0.4, 2, 1.8], [1, 3.3, 1.4]]
 
+    Each sample (a value of one parameter) is an independent task, so the
+    samples can be run by a pool of worker processes. The results do not
+    depend on the amount of processes.
+
     Args:
         parameters: dict, of parameter ranges, see PARAMETERS.
         samples_per_param: int, points on the interval for each parameter.
         runs_per_sample: int, the amount of replicates for each sample.
         model_iterations: int, amount of iterations to run each model.
         comparison_methods: dict of string to comparison function.
+        processes: int, amount of worker processes running the samples (see
+            `run_sobol_analysis`).
 
     """
     # Set up before the run, including results matrix.
@@ -270,44 +488,62 @@ def run_ofat_analysis(parameters=PARAMETERS,
     print("\nTotal runs: {}".format(
         len(parameters["names"]) * samples_per_param * runs_per_sample))
 
-    # Iterate through each parameter e.g. class_size.
+    # One task for each value of each parameter e.g. class_size.
+    tasks = []
     for j, param_name in enumerate(parameters["names"]):
         bounds = parameters["bounds"][j]
-        print("\nRunning OFAT on {}, bounds {}".format(param_name, bounds))
+        print("OFAT on {}, bounds {}".format(param_name, bounds))
         param_values = np.linspace(*bounds, samples_per_param)
 
         # Iterate through all the values for this parameter.
         for i, param_value in enumerate(param_values):
             sample_params = default_params[:]  # Copy of default parameters.
             sample_params[j] = param_value  # Set value for current parameter.
-            sample_measures = []  # Collect results from each replicate here.
-
-            # One run for each replicate.
-            for _ in range(runs_per_sample):
-                measures = run(
-                    *sample_params,
-                    model_iterations=model_iterations,
-                    comparison_methods=comparison_methods,
-                    scale=OFAT_SCALE_COEFS)
-                sample_measures.append(measures)
-                run_count += 1
-                print("\nRun: {}\nparameters: {}\nmeasures: {}".format(
-                    run_count, sample_params, measures))
-
-            # Set the element E (see function docstring) in results matrix.
-            E = np.empty((len(comparison_methods), num_points))
-            # TODO: Why is this axis=0 and not axis=1 :s ? But it works so..
-            mean = np.array(sample_measures).mean(axis=0)
-            min_ = np.array(sample_measures).min(axis=0)
-            max_ = np.array(sample_measures).max(axis=0)
-            var = np.array(sample_measures).var(axis=0)
-            print("min: {}".format(min_))
-            print("mean: {}".format(mean))
-            print("max: {}".format(max_))
-            print("var: {}".format(var))
-            for k in range(len(comparison_methods)):
-                E[k] = [min_[k], max_[k], mean[k], var[k]]
-            results[i][j] = E
+            tasks.append((i, j, sample_params, runs_per_sample,
+                          model_iterations))
+
+    def save(i, j, sample_measures):
+        """Print the measures of a finished sample and set its element E in
+        the results matrix."""
+        nonlocal run_count
+        sample_params = tasks[j * samples_per_param + i][2]
+        for measures in sample_measures:
+            run_count += 1
+            print("\nRun: {}\nparameters: {}\nmeasures: {}".format(
+                run_count, sample_params, measures))
+
+        # Set the element E (see function docstring) in results matrix.
+        E = np.empty((len(comparison_methods), num_points))
+        # TODO: Why is this axis=0 and not axis=1 :s ? But it works so..
+        mean = np.array(sample_measures).mean(axis=0)
+        min_ = np.array(sample_measures).min(axis=0)
+        max_ = np.array(sample_measures).max(axis=0)
+        var = np.array(sample_measures).var(axis=0)
+        print("min: {}".format(min_))
+        print("mean: {}".format(mean))
+        print("max: {}".format(max_))
+        print("var: {}".format(var))
+        for k in range(len(comparison_methods)):
+            E[k] = [min_[k], max_[k], mean[k], var[k]]
+        results[i][j] = E
+
+        elapsed = time.time() - start_time
+        print("Finished {}/{} samples ({:.2f} runs/s)".format(
+            run_count // runs_per_sample, len(tasks), run_count / elapsed))
+
+    # Run the samples in this process or by the workers, in any order.
+    start_time = time.time()
+    if processes > 1:
+        class_sizes = [task[2][4] for task in tasks]
+        for i, j, sample_measures in run_pool(
+                ofat_worker, tasks, processes, comparison_methods,
+                class_sizes):
+            save(i, j, sample_measures)
+    else:
+        for i, j, sample_params, _, _ in tasks:
+            save(i, j, get_ofat_sample_measures(
+                sample_params, runs_per_sample, model_iterations,
+                comparison_methods))
     return results
 
 
@@ -383,9 +619,14 @@ if __name__ == "__main__":
     ofat_results_path = os.path.join(RESULTS_PATH, OFAT_RESULTS_FILENAME)
     sobol_results_path = os.path.join(RESULTS_PATH, SOBOL_RESULTS_FILENAME)
 
+    processes = PROCESSES
+    for arg in sys.argv:
+        if arg.startswith("--processes="):
+            processes = int(arg.split("=")[1])
+
     if "--ofat-run" in sys.argv:
         print("Starting OFAT run...\n")
-        results = run_ofat_analysis()
+        results = run_ofat_analysis(processes=processes)
         with open(ofat_results_path, "wb") as f:
             pickle.dump(results, f)
         print("\nSaved results to {}".format(ofat_results_path))
@@ -399,7 +640,9 @@ if __name__ == "__main__":
 
     elif "--sobol-run" in sys.argv:
         print("Starting SOBOL run...\n")
-        results = run_sobol_analysis(fixed_class_size=130)
+        results = run_sobol_analysis(
+            fixed_class_size=130, processes=processes,
+            store_path=os.path.join(RESULTS_PATH, SOBOL_STORE_FILENAME))
         with open(sobol_results_path, "wb") as f:
             pickle.dump(results, f)
         print("\nSaved results to {}".format(sobol_results_path))
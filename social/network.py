@@ -1,5 +1,6 @@
 import collections
 import scipy
+from scipy import sparse
 import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
@@ -10,6 +11,18 @@ inner: percentage of edges within groups
 outer: percentage of edges between groups
 """
 
+def to_sparse_matrix(G):
+    """ Return the connectivity matrix of an undirected graph with nodes 0..n-1
+    in CSR format (ones mean edge between nodes)
+    """
+    n = G.number_of_nodes()
+    edges = np.array(list(G.edges()), dtype=int).reshape(-1, 2)
+    edges = edges[edges[:, 0] != edges[:, 1]]
+    rows = np.concatenate((edges[:, 0], edges[:, 1]))
+    cols = np.concatenate((edges[:, 1], edges[:, 0]))
+    return sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, cols)), shape=(n, n))
+
 def social_graph(groups, inner, outer, plot):
     # create graph
     G = nx.random_partition_graph(groups, inner, outer)
@@ -19,9 +32,9 @@ def social_graph(groups, inner, outer, plot):
         nx.draw_networkx(G)
         plt.show()
 
-    # print numpy array of social graph
+    # sparse connectivity matrix of social graph
     # ones means edge between nodes, otherwise zero
-    c = nx.to_numpy_matrix(G)
+    c = to_sparse_matrix(G)
     return c
 
 # random graph: Erdős - Renyi model
@@ -34,8 +47,8 @@ def erdos_renyi(n, p, plot = False):
         nx.draw_networkx(G)
         plt.show()
 
-    # return a numpy matrix (undirected)
-    c = nx.to_numpy_matrix(G)
+    # return a sparse connectivity matrix (undirected)
+    c = to_sparse_matrix(G)
     return c, G
 
 # random graph: Barabási–Albert model
@@ -47,8 +60,8 @@ def barabasi_albert(n, m, plot = False):
         nx.draw_networkx(G)
         plt.show()
 
-    # return a numpy matrix (undirected)
-    c = nx.to_numpy_matrix(G)
+    # return a sparse connectivity matrix (undirected)
+    c = to_sparse_matrix(G)
     return c, G
 
 def walts_graph(degree_sequence, plot = False):
@@ -107,7 +120,76 @@ def walts_graph(degree_sequence, plot = False):
         nx.draw(G)
         plt.show()
 
-    return C, G
+    return sparse.csr_matrix(C), G
+
+def configuration_graph(degree_sequence, rand=np.random, max_rounds=10, plot=False):
+    """ Random graph with the given degree sequence (configuration model)
+
+    Every agent i gets degree_sequence[i] stubs, rounded to the nearest
+    integer (one agent gets an extra stub if the total is odd). All stubs are
+    shuffled and matched in pairs; pairs forming self-loops or multi-edges are
+    rejected and their stubs are matched again in the next round. Stubs that
+    cannot be matched remain as residual degrees.
+
+    Args:
+        degree_sequence: desired number of connections per agent
+        rand: random number generator (np.random or a RandomState)
+        max_rounds: maximal number of rounds to match rejected stubs
+
+    Returns:
+        C: symmetric connectivity matrix in CSR format (1 means friendship)
+        residual: number of unmatched connections per agent
+    """
+    # the sampled degrees may be fractional: round them to the nearest integer
+    # and, if the number of stubs is odd, round up the agent that lost most
+    desired = np.asarray(degree_sequence, dtype=float)
+    degrees = np.rint(desired).astype(int)
+    if np.sum(degrees) % 2:
+        degrees[np.argmax(desired - degrees)] += 1
+    N = len(degrees)
+
+    stubs = np.repeat(np.arange(N), degrees)
+    edge_keys = np.zeros(0, dtype=np.int64)
+
+    for _ in range(max_rounds):
+        if len(stubs) < 2:
+            break
+        rand.shuffle(stubs)
+        num_pairs = len(stubs) // 2
+        pairs = stubs[:2*num_pairs].reshape(num_pairs, 2)
+        a, b = pairs.min(axis=1), pairs.max(axis=1)
+        keys = a.astype(np.int64) * N + b
+
+        # reject self-loops, existing edges and duplicates within this round
+        _, first = np.unique(keys, return_index=True)
+        accepted = np.zeros(num_pairs, dtype=bool)
+        accepted[first] = True
+        accepted &= (a != b) & ~np.isin(keys, edge_keys)
+
+        if not np.any(accepted):
+            break
+        edge_keys = np.concatenate((edge_keys, keys[accepted]))
+        stubs = np.concatenate(
+            (pairs[~accepted].ravel(), stubs[2*num_pairs:]))
+
+    rows, cols = edge_keys // N, edge_keys % N
+    C = sparse.csr_matrix(
+        (np.ones(2*len(edge_keys)),
+         (np.concatenate((rows, cols)), np.concatenate((cols, rows)))),
+        shape=(N, N))
+    residual = degrees - np.diff(C.indptr)
+
+    if plot:
+        print('Residual of number of connections:', residual)
+
+        # Plot the network
+        G = nx.Graph()
+        G.add_nodes_from(range(N))
+        G.add_edges_from(zip(rows, cols))
+        nx.draw(G)
+        plt.show()
+
+    return C, residual
 
 def graph_to_histogram(G):
     degree_sequence = sorted([d for n, d in G.degree().items()], reverse=True)  # degree sequence
@@ -139,3 +221,6 @@ if __name__ == "__main__":
     degree_sequence = [5, 12, 3, 25, 9, 10, 6, 20, 20, 8, 7, 15, 16, 30, 3, 5, 20, 3, 10, 20, 20, 40, 10, 10, 8, 45, 8, 5, 6, 9, 35, 30, 10, 5, 15, 3, 40, 25, 40, 10, 15, 5, 16, 30, 6, 40, 17, 25, 8, 30, 50, 20, 20, 4, 10, 6, 12, 15, 30, 20, 7, 6, 7, 30, 50, 25, 25, 10, 15, 5, 30, 5, 6, 15, 15]
     C, G = walts_graph(degree_sequence, plot = True)
     graph_to_histogram(G)
+
+    # create configuration model graph with the same degree sequence
+    C, residual = configuration_graph(degree_sequence, plot = True)